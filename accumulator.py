@@ -0,0 +1,136 @@
+import numpy as np
+
+
+class FeatureTypeStats:
+    """
+    Mergeable statistics of annotations grouped by feature type.
+
+    For every type the `sum_columns` are summed and the `mean_columns` keep their count
+    of non-NaN values, sum, sum of squares, minimum and maximum. Updates take whole
+    NumPy arrays and two instances merge associatively, so batches, genomes or workers
+    can be summarised independently and combined in any order.
+    """
+
+    def __init__(self, sum_columns, mean_columns):
+        self.sum_columns = list(sum_columns)
+        self.mean_columns = list(mean_columns)
+        self.types = {}
+
+    def _empty(self):
+        size = len(self.mean_columns)
+        return {
+            "sums": np.zeros(len(self.sum_columns), dtype=np.int64),
+            "count": np.zeros(size, dtype=np.int64),
+            "sum": np.zeros(size),
+            "sumsq": np.zeros(size),
+            "min": np.full(size, np.inf),
+            "max": np.full(size, -np.inf),
+        }
+
+    def update(self, types, sums, values):
+        """Adds a batch of annotations.
+
+        Args:
+            types (np.ndarray): feature type of every annotation
+            sums (np.ndarray): annotations x `sum_columns` values to sum
+            values (np.ndarray): annotations x `mean_columns` values to average, NaN is skipped
+        """
+        if not len(types):
+            return
+
+        names, first, inverse = np.unique(
+            np.asarray(types, dtype=object), return_index=True, return_inverse=True
+        )
+        size = len(names)
+        valid = ~np.isnan(values)
+        clean = np.where(valid, values, 0.0)
+
+        batch = {
+            "sums": np.zeros((size, len(self.sum_columns)), dtype=np.int64),
+            "count": np.zeros((size, len(self.mean_columns)), dtype=np.int64),
+            "sum": np.zeros((size, len(self.mean_columns))),
+            "sumsq": np.zeros((size, len(self.mean_columns))),
+            "min": np.full((size, len(self.mean_columns)), np.inf),
+            "max": np.full((size, len(self.mean_columns)), -np.inf),
+        }
+        np.add.at(batch["sums"], inverse, sums)
+        np.add.at(batch["count"], inverse, valid)
+        np.add.at(batch["sum"], inverse, clean)
+        np.add.at(batch["sumsq"], inverse, clean * clean)
+        np.minimum.at(batch["min"], inverse, np.where(valid, values, np.inf))
+        np.maximum.at(batch["max"], inverse, np.where(valid, values, -np.inf))
+
+        # types keep the order of their first annotation
+        for ix in np.argsort(first, kind="stable").tolist():
+            self._merge_type(names[ix], {key: part[ix] for key, part in batch.items()})
+
+    def _merge_type(self, name, other):
+        state = self.types.setdefault(name, self._empty())
+        for key in ("sums", "count", "sum", "sumsq"):
+            state[key] = state[key] + other[key]
+        state["min"] = np.minimum(state["min"], other["min"])
+        state["max"] = np.maximum(state["max"], other["max"])
+
+    def merge(self, other):
+        """Adds all statistics of another `FeatureTypeStats` with the same columns"""
+        for name, state in other.types.items():
+            self._merge_type(name, state)
+        return self
+
+    def mean(self, name):
+        state = self.types[name]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(state["count"] > 0, state["sum"] / state["count"], np.nan)
+
+    def rows(self, names=None):
+        """`[type, *sums, *means]` rows of the given types, all types by default"""
+        for name in self.types if names is None else names:
+            yield [name] + self.types[name]["sums"].tolist() + self.mean(name).tolist()
+
+    def to_dict(self):
+        return {
+            "sum_columns": self.sum_columns,
+            "mean_columns": self.mean_columns,
+            "types": {
+                name: {key: values.tolist() for key, values in state.items()}
+                for name, state in self.types.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data["sum_columns"], data["mean_columns"])
+        for name, state in data["types"].items():
+            stats.types[name] = {
+                key: np.asarray(values, dtype=stats._empty()[key].dtype)
+                for key, values in state.items()
+            }
+        return stats
+
+    @classmethod
+    def from_rows(cls, rows, sum_columns, mean_columns):
+        """
+        Approximates the statistics from already averaged `[type, *sums, *means]` rows,
+        every mean counts once per feature given in the first sum column
+        """
+        stats = cls(sum_columns, mean_columns)
+        for row in rows:
+            if not isinstance(row[0], str):
+                continue
+            sums = np.nan_to_num(np.array(row[1 : 1 + len(sum_columns)], dtype=float))
+            means = np.array(row[1 + len(sum_columns) :], dtype=float)
+            valid = ~np.isnan(means)
+            weight = np.where(valid, sums[0], 0.0)
+            clean = np.where(valid, means, 0.0)
+            stats._merge_type(
+                row[0],
+                {
+                    "sums": sums.astype(np.int64),
+                    "count": weight.astype(np.int64),
+                    "sum": clean * weight,
+                    "sumsq": clean * clean * weight,
+                    "min": np.where(valid, means, np.inf),
+                    "max": np.where(valid, means, -np.inf),
+                },
+            )
+        return stats
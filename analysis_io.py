@@ -0,0 +1,188 @@
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils import _ANALYSIS_COLUMNS, _DIRS
+
+
+def analysis_path(ncbi: str, analysis: str):
+    return _DIRS[analysis] / f"{ncbi}_{analysis}.csv"
+
+
+def _cache_dir(path):
+    """
+    cache directory for the given analysis export, keyed on its path, size and mtime
+    """
+    stat = path.stat()
+    key = hashlib.sha1(
+        f"{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    ).hexdigest()[:16]
+    return _DIRS["cache"] / f"{path.stem}-{key}"
+
+
+def read_analysis(ncbi: str, analysis: str):
+    """Reads the numeric columns of a DNA Analyser export.
+
+    The first read parses the tab separated file and stores every used column as a typed
+    `.npy` array in the cache folder. Following reads of an unchanged file memory-map
+    those arrays instead of parsing the CSV again.
+
+    Args:
+        ncbi (str): NCBI ID of the analysed sequence
+        analysis (str): analysis type, one of `palindrome`, `g4` or `rloop`
+
+    Returns:
+        pd.DataFrame: one column per used analysis column, named as in the export
+    """
+    path = analysis_path(ncbi, analysis)
+    columns = _ANALYSIS_COLUMNS[analysis]
+    cache = _cache_dir(path)
+
+    if cache.is_dir():
+        return pd.DataFrame(
+            {col: np.load(cache / f"{col}.npy", mmap_mode="r") for col in columns},
+            copy=False,
+        )
+
+    df = pd.read_csv(
+        path,
+        delimiter="\t",
+        usecols=list(columns.keys()),
+        dtype=columns,
+    )
+    df = df[list(columns.keys())]
+
+    try:
+        _DIRS["cache"].mkdir(exist_ok=True)
+        tmp = cache.with_name(f"{cache.name}.tmp{os.getpid()}")
+        tmp.mkdir()
+        for col in columns:
+            np.save(tmp / f"{col}.npy", df[col].to_numpy())
+        # drop caches of older versions of the same file
+        for old in _DIRS["cache"].glob(f"{path.stem}-" + "?" * 16):
+            shutil.rmtree(old, ignore_errors=True)
+        os.replace(tmp, cache)
+    except OSError as exc:
+        print(f"Unable to cache {path}: {exc}")
+
+    return df
+
+
+def iter_analysis_chunks(ncbi: str, analysis: str, chunksize: int):
+    """Streams the numeric columns of a DNA Analyser export.
+
+    Args:
+        ncbi (str): NCBI ID of the analysed sequence
+        analysis (str): analysis type, one of `palindrome`, `g4` or `rloop`
+        chunksize (int): number of rows per chunk
+
+    Yields:
+        pd.DataFrame: chunks of at most `chunksize` rows, the index continues over chunks,
+            at least one (possibly empty) chunk is always yielded
+    """
+    columns = _ANALYSIS_COLUMNS[analysis]
+    empty = True
+
+    with pd.read_csv(
+        analysis_path(ncbi, analysis),
+        delimiter="\t",
+        usecols=list(columns.keys()),
+        dtype=columns,
+        chunksize=chunksize,
+    ) as reader:
+        for chunk in reader:
+            empty = False
+            yield chunk[list(columns.keys())]
+
+    if empty:
+        yield pd.DataFrame(
+            {col: np.empty(0, dtype=dtype) for col, dtype in columns.items()}
+        )
+
+
+class WindowSpill:
+    """
+    Spills analysis rows to disk, one binary file per `window` nucleotides of the genome.
+
+    Rows are assigned to windows by one of their position columns, so any part of the genome
+    can be loaded back with bounded memory, no matter how the source file is ordered.
+    """
+
+    def __init__(self, directory, window: int):
+        self.directory = Path(directory)
+        self.window = window
+        self.dtype = None
+
+    def _path(self, window):
+        return self.directory / f"{window}.bin"
+
+    def add(self, df: pd.DataFrame, key: str):
+        """Appends the rows of `df` to the windows given by its `key` column"""
+        if self.dtype is None:
+            self.dtype = np.dtype(
+                [("row", np.int64)] + [(col, df[col].dtype) for col in df.columns]
+            )
+
+        rows = np.empty(len(df), dtype=self.dtype)
+        rows["row"] = df.index
+        for col in df.columns:
+            rows[col] = df[col]
+
+        windows = df[key].to_numpy() // self.window
+        order = np.argsort(windows, kind="stable")
+        bounds = np.flatnonzero(np.diff(windows[order])) + 1
+        for part in np.split(order, bounds):
+            if len(part):
+                with open(self._path(windows[part[0]]), "ab") as out:
+                    rows[part].tofile(out)
+
+    def windows(self):
+        return sorted(int(path.stem) for path in self.directory.glob("*.bin"))
+
+    def load(self, windows):
+        """Loads the rows of the given windows, in their original order"""
+        parts = [
+            np.fromfile(self._path(window), dtype=self.dtype)
+            for window in windows
+            if self._path(window).is_file()
+        ]
+        rows = np.concatenate(parts) if parts else np.empty(0, dtype=self.dtype)
+        return self._frame(rows)
+
+    def stream(self, windows, size: int):
+        """
+        Yields the rows of the given windows in their original order, at most `size` rows
+        at a time. Window files are memory-mapped and read one range of rows at a time,
+        rows of every window file are already in their original order.
+        """
+        files = [
+            np.memmap(self._path(window), dtype=self.dtype, mode="r")
+            for window in windows
+            if self._path(window).is_file()
+        ]
+        if not files:
+            return
+
+        positions = [0] * len(files)
+        first = min(int(rows["row"][0]) for rows in files)
+        last = max(int(rows["row"][-1]) for rows in files)
+        for low in range(first, last + 1, size):
+            parts = []
+            for ix, rows in enumerate(files):
+                stop = int(np.searchsorted(rows["row"], low + size))
+                if stop > positions[ix]:
+                    parts.append(np.array(rows[positions[ix] : stop]))
+                    positions[ix] = stop
+            if parts:
+                yield self._frame(np.concatenate(parts))
+
+    def _frame(self, rows):
+        rows = rows[np.argsort(rows["row"], kind="stable")]
+        return pd.DataFrame(
+            {col: rows[col] for col in self.dtype.names[1:]},
+            index=rows["row"],
+        )
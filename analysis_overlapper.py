@@ -1,29 +1,111 @@
-import matplotlib
-import matplotlib.pyplot as plt
+import io
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
-import pyfastx
 
-from feature import overlap_with_annotations
-from remote_api import Remote
-from utils import _DIRS
+from analysis_io import WindowSpill, iter_analysis_chunks, read_analysis
+from feature import SPILL_WINDOW, overlap_with_annotations, prefetch_inputs
+from out import aggregate_palindromes, read_result
+from overlap import bin_intervals, pair_by_middle
+from plots import plot_heatmaps, plot_overlap
+from result_cache import is_current
+from sequence_index import sequence_info
+from utils import _DIRS, atomic_path
+
+
+def first_intervals(df):
+    df = df[["POSITION", "LENGTH"]]
+    df["Start_x"] = df["POSITION"]
+    df["End_x"] = df["Start_x"] + df["LENGTH"]
+    return df.drop(columns=["POSITION", "LENGTH"])
+
+
+def second_intervals(df):
+    df = df[["POSITION", "LENGTH"]]
+    df["Start_y"] = df["POSITION"]
+    df["End_y"] = df["Start_y"] + df["LENGTH"]
+    df["Middle_y"] = ((df["Start_y"] + df["End_y"]) // 2).astype(np.int32)
+    return df.drop(columns=["POSITION", "LENGTH"])
+
+
+def join_analyses(first_data, second_data):
+    """
+    includes second analysis where its middle is still in the first analysis,
+    only the matching pairs are produced instead of a full cross join
+    """
+    first_ix, second_ix = pair_by_middle(
+        first_data["Start_x"].to_numpy(),
+        first_data["End_x"].to_numpy(),
+        second_data["Middle_y"].to_numpy(),
+    )
+    return pd.concat(
+        [
+            first_data.iloc[first_ix].reset_index(drop=True),
+            second_data.iloc[second_ix].reset_index(drop=True),
+        ],
+        axis=1,
+    )
 
 
-def overlap_analysis_files(first, second, ncbi):
+def join_analyses_chunked(first, second, ncbi, chunksize):
+    """
+    same as `join_analyses`, but both analyses are streamed in chunks of `chunksize` rows
+    and spilled to disk by genome window, only one window of the first analysis
+    and the windows of the second one it reaches are held in memory
+    """
+    _DIRS["cache"].mkdir(exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=_DIRS["cache"]) as tmp:
+        (Path(tmp) / "first").mkdir()
+        (Path(tmp) / "second").mkdir()
+        first_spill = WindowSpill(Path(tmp) / "first", SPILL_WINDOW)
+        second_spill = WindowSpill(Path(tmp) / "second", SPILL_WINDOW)
+
+        for chunk in iter_analysis_chunks(ncbi, first, chunksize):
+            first_spill.add(first_intervals(chunk), "Start_x")
+        for chunk in iter_analysis_chunks(ncbi, second, chunksize):
+            second_spill.add(second_intervals(chunk), "Middle_y")
+
+        parts = []
+        for window in first_spill.windows():
+            first_data = first_spill.load([window])
+            last = first_data["End_x"].max() // SPILL_WINDOW
+            second_data = second_spill.load(range(window, last + 1))
+            parts.append(join_analyses(first_data, second_data))
+
+    if not parts:
+        return join_analyses(first_spill.load([]), second_spill.load([]))
+    return pd.concat(parts, ignore_index=True)
+
+
+def overlap_analysis_files(
+    first, second, ncbi, chunksize=None, fmt="xlsx", bins=100, plots="publication"
+):
     print(f"Comparing analyses {first} x {second} for {ncbi}")
-    api = Remote(ncbi)
 
     first_file = _DIRS[first] / f"{ncbi}_{first}.csv"
     second_file = _DIRS[second] / f"{ncbi}_{second}.csv"
 
     try:
 
-        if not (_DIRS["results"] / f"{ncbi}.xlsx").is_file():
+        if not is_current(ncbi, (first,), fmt):
             print(
                 f"No annotation overlap with {first} analysis found, trying to process..."
             )
-            overlap_with_annotations(first, [ncbi])
+            # aggregated once by `overlap_analyses` after all genomes are compared
+            overlap_with_annotations(
+                (first,), [ncbi], chunksize=chunksize, fmt=fmt, aggregate=False
+            )
+
+        if not first_file.is_file() or not second_file.is_file():
+            # the HTTP client is loaded only when something has to be downloaded
+            from remote_api import Remote
 
+            api = Remote(ncbi)
         if not first_file.is_file():
             print(
                 f"Missing input ncbi file for {first} analysis, trying to download..."
@@ -36,43 +118,16 @@ def overlap_analysis_files(first, second, ncbi):
             api.get_analysis(second)
     except Exception as exc:
         print(f"Unable to download analysis files due to {exc}.")
-        exit(0)
-
-    first_data = pd.read_csv(
-        first_file,
-        usecols=["POSITION", "LENGTH"],
-        dtype={"POSITION": np.int32, "LENGTH": np.int16},
-        sep="\t",
-    )
-
-    second_data = pd.read_csv(
-        second_file,
-        usecols=["POSITION", "LENGTH"],
-        dtype={"POSITION": np.int32, "LENGTH": np.int16},
-        sep="\t",
-    )
-
-    first_data["Start_x"] = first_data["POSITION"]
-    first_data["End_x"] = first_data["Start_x"] + first_data["LENGTH"]
-    first_data["NCBI_ID"] = ncbi
-
-    second_data["Start_y"] = second_data["POSITION"]
-    second_data["End_y"] = second_data["Start_y"] + second_data["LENGTH"]
-    second_data["NCBI_ID"] = ncbi
-    second_data["Middle_y"] = (
-        (second_data["Start_y"] + second_data["End_y"]) // 2
-    ).astype(np.int32)
-
-    first_data = first_data.drop(columns=["POSITION", "LENGTH"])
-    second_data = second_data.drop(columns=["POSITION", "LENGTH"])
-
-    df = pd.merge(first_data, second_data, on="NCBI_ID")
-    df = df.drop(columns=["NCBI_ID"])
+        return
 
-    # include second analysis where its middle is still in the first analysis
-    df = df.loc[
-        (df["Middle_y"] >= df["Start_x"]) & (df["Middle_y"] <= df["End_x"])
-    ].sort_values(by=["Start_x"])
+    if chunksize is None:
+        df = join_analyses(
+            first_intervals(read_analysis(ncbi, first)),
+            second_intervals(read_analysis(ncbi, second)),
+        )
+    else:
+        df = join_analyses_chunked(first, second, ncbi, chunksize)
+    df = df.sort_values(by=["Start_x"], kind="stable")
 
     # cut the intervals to match
     df.loc[df["Start_y"] < df["Start_x"], "Start_y"] = df["Start_x"]
@@ -90,21 +145,30 @@ def overlap_analysis_files(first, second, ncbi):
     df_agg["Middle_x"] = ((df_agg["Start_x_"] + df_agg["End_x_"]) // 2).astype(np.int32)
 
     # Excel output
-    writer = pd.ExcelWriter(
-        _DIRS["results"] / f"{ncbi}_{first}_{second}.xlsx", engine="xlsxwriter"
-    )
-    df.to_excel(
-        writer, sheet_name=f"{first.capitalize()} to {second.capitalize()}", index=False
-    )
-    df_agg.to_excel(
-        writer,
-        sheet_name=f"{first.capitalize()} to {second.capitalize()} GROUPED",
-        index=False,
-    )
-    writer.close()
+    if fmt in ("xlsx", "both"):
+        with atomic_path(_DIRS["results"] / f"{ncbi}_{first}_{second}.xlsx") as tmp:
+            writer = pd.ExcelWriter(tmp, engine="xlsxwriter")
+            df.to_excel(
+                writer,
+                sheet_name=f"{first.capitalize()} to {second.capitalize()}",
+                index=False,
+            )
+            df_agg.to_excel(
+                writer,
+                sheet_name=f"{first.capitalize()} to {second.capitalize()} GROUPED",
+                index=False,
+            )
+            writer.close()
+    if fmt in ("parquet", "both"):
+        with atomic_path(_DIRS["results"] / f"{ncbi}_{first}_{second}.parquet") as tmp:
+            df.to_parquet(tmp, index=False)
+        with atomic_path(
+            _DIRS["results"] / f"{ncbi}_{first}_{second}.grouped.parquet"
+        ) as tmp:
+            df_agg.to_parquet(tmp, index=False)
 
     # load features
-    df_feat = pd.read_excel(_DIRS["results"] / f"{ncbi}.xlsx", f"Feature to {first}s")
+    df_feat = read_result(ncbi, f"Feature to {first}s")
     df_feat.drop_duplicates(
         subset=["Feature start", "Feature end"], keep="last", inplace=True
     )  # remove features on the same interval
@@ -116,109 +180,114 @@ def overlap_analysis_files(first, second, ncbi):
         df_agg[df_agg[f"Overlap_count"] < 1].index, inplace=True
     )  # remove 0 analysis overlap !!!
 
-    df_feat.to_csv(_DIRS["results"] / f"raw_{ncbi}_feature.csv")
-    df_agg.to_csv(_DIRS["results"] / f"raw_{ncbi}_agg.csv")
+    with atomic_path(_DIRS["results"] / f"raw_{ncbi}_feature.csv") as tmp:
+        df_feat.to_csv(tmp)
+    with atomic_path(_DIRS["results"] / f"raw_{ncbi}_agg.csv") as tmp:
+        df_agg.to_csv(tmp)
+    # raw files are shared by all pairs, the plots are rendered again from this one
+    with atomic_path(_DIRS["results"] / f"{ncbi}_{first}_{second}_agg.csv") as tmp:
+        df_agg.to_csv(tmp)
 
     if df_agg.empty or df_feat.empty:
         print(f"{ncbi} has empty dataframe!")
         return
 
     # FIRST GRAPH -> Overlap between analyses
+    plot_overlap(df_agg, first, second, ncbi, plots)
 
-    df_best_regions = df_agg.loc[df_agg["Overlap_count"] >= 0]
-    x = df_best_regions["Middle_x"]
-    width = 10000  # the width of the bars
+    # SECOND GRAPH -> HEATMAPS
+    seq_len = sequence_info(ncbi)["length"]
 
-    fig, ax = plt.subplots()
-    rects1 = ax.bar(
-        x - width / 2,
-        round(df_best_regions["Overlap_max"] * 100),
-        width,
-        label="Overlap max coverage [%]",
-    )
-    rects2 = ax.bar(
-        x + width / 2,
-        df_best_regions["Overlap_count"],
-        width,
-        label="Overlap region count [N]",
+    bin_starts, bin_ends, heatmap_analysis = bin_intervals(
+        df_agg.loc[df_agg["Overlap_count"] > 0, "Start_x_"].to_numpy(),
+        df_agg.loc[df_agg["Overlap_count"] > 0, "End_x_"].to_numpy(),
+        seq_len,
+        bins,
     )
-    ax.set_ylabel("Overlap")
-    ax.set_xlabel("Sequence length [N]")
-    ax.set_title(
-        f"{first.capitalize()} to {second.capitalize()} max coverage to occurence ratio [{ncbi}]"
+    counted = df_feat[f"{first.capitalize()}s count"] > 0
+    _, _, heatmap_features = bin_intervals(
+        df_feat.loc[counted, "Feature start"].to_numpy(),
+        df_feat.loc[counted, "Feature end"].to_numpy(),
+        seq_len,
+        bins,
     )
-    ax.legend()
-    ax.set_xlim(x.min() - width, x.max() + width)
-    plt.xticks(np.arange(0, x.max() + width, 100000))
-
-    figure = plt.gcf()
-    figure.set_size_inches(19.2, 10.8)
-    plt.savefig(
-        f"./results/{ncbi}_analysis.png", dpi=600, format="png", bbox_inches="tight"
-    )
-
-    # SECOND GRAPH -> HEATMAPS
-    seq_len = pyfastx.Fasta(f"./sequences/{ncbi}.fasta").size  # TODO: via API
-
-    one_percent = seq_len / 100
-    heatmap_analysis = []
-    heatmap_features = []
-
-    for i in range(0, 100):
-        relative_start = int(i * one_percent)
-        relative_end = int(relative_start + 1 + one_percent)
-        heatmap_analysis.append(
-            len(
-                df_agg.loc[
-                    (df_agg["Overlap_count"] > 0)
-                    & (df_agg["Start_x_"] >= relative_start)
-                    & (df_agg["End_x_"] <= relative_end)
-                ]
-            )
-        )
-        heatmap_features.append(
-            len(
-                df_feat.loc[
-                    (df_feat[f"{first.capitalize()}s count"] > 0)
-                    & (df_feat["Feature start"] >= relative_start)
-                    & (df_feat["Feature end"] <= relative_end)
-                ]
-            )
-        )
-        plt.rcParams["figure.figsize"] = 5, 2
 
-    x = np.array([i for i in range(0, 100)])
-    y1 = np.array(heatmap_analysis)
-    y2 = np.array(heatmap_features)
-
-    fig, (ax, ax1) = plt.subplots(nrows=2, sharex=True)
-
-    extent = [x[0] - (x[1] - x[0]) / 2.0, x[-1] + (x[1] - x[0]) / 2.0, 0, 1]
-
-    pos_ax = ax.imshow(y1[np.newaxis, :], cmap="plasma", aspect="auto", extent=extent)
-    fig.colorbar(pos_ax, ax=ax)
+    df_heatmap = pd.DataFrame(
+        {
+            "Bin start": bin_starts,
+            "Bin end": bin_ends,
+            f"{first.capitalize()}s with {second}s": heatmap_analysis,
+            f"{first.capitalize()}s with features": heatmap_features,
+        }
+    )
+    with atomic_path(_DIRS["results"] / f"{ncbi}_{first}_{second}_heatmap.csv") as tmp:
+        df_heatmap.to_csv(tmp, index=False)
+    if fmt in ("parquet", "both"):
+        with atomic_path(
+            _DIRS["results"] / f"{ncbi}_{first}_{second}_heatmap.parquet"
+        ) as tmp:
+            df_heatmap.to_parquet(tmp, index=False)
 
-    pos_ax1 = ax1.imshow(y2[np.newaxis, :], cmap="plasma", aspect="auto", extent=extent)
-    fig.colorbar(pos_ax1, ax=ax1)
+    plot_heatmaps(df_heatmap, first, second, ncbi, plots)
 
-    ax.set_yticks([])
-    ax.set_xlim(extent[0], extent[1])
-    ax1.set_yticks([])
-    ax1.set_xlim(extent[0], extent[1])
 
-    ax.set_title(
-        f"Overlap count for {second.capitalize()}s and {first.capitalize()}s [{ncbi}]"
-    )
-    ax1.set_title(f"Overlap count for {first.capitalize()}s and annotations [{ncbi}]")
-
-    ax.set_xlabel("Sequence length [N]")
-    ax.set_ylabel("Overlap count [N]")
-    ax1.set_xlabel("Sequence length [N]")
-    ax1.set_ylabel("Overlap count [N]")
-
-    plt.tight_layout()
-    figure = plt.gcf()
-    figure.set_size_inches(8, 6)
-    plt.savefig(
-        f"./results/{ncbi}_count.png", dpi=600, format="png", bbox_inches="tight"
-    )
+def _compare(first, second, ncbi, chunksize, fmt, bins, plots):
+    """compares one NCBI ID and reports its failure, so the other IDs still run"""
+    try:
+        overlap_analysis_files(
+            first,
+            second,
+            ncbi,
+            chunksize=chunksize,
+            fmt=fmt,
+            bins=bins,
+            plots=plots,
+        )
+    except Exception as exc:
+        print(f"ERROR occured while comparing {first} x {second} for {ncbi}: {exc}")
+
+
+def _compare_in_worker(first, second, ncbi, chunksize, fmt, bins, plots):
+    out = io.StringIO()
+    with redirect_stdout(out):
+        _compare(first, second, ncbi, chunksize, fmt, bins, plots)
+    return out.getvalue()
+
+
+def overlap_analyses(
+    first,
+    second,
+    ncbis,
+    chunksize=None,
+    jobs=1,
+    fmt="xlsx",
+    bins=100,
+    plots="publication",
+    downloads=8,
+):
+    """
+    compares two analyses for every NCBI ID, with `jobs` > 1 on a process pool;
+    output of every ID is printed in the given order
+    """
+    prefetch_inputs(ncbis, downloads, analyses=(first, second))
+
+    if jobs <= 1:
+        for ncbi in ncbis:
+            _compare(first, second, ncbi, chunksize, fmt, bins, plots)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [
+                pool.submit(
+                    _compare_in_worker, first, second, ncbi, chunksize, fmt, bins, plots
+                )
+                for ncbi in ncbis
+            ]
+            for ncbi, future in zip(ncbis, futures):
+                try:
+                    print(future.result(), end="")
+                except Exception as exc:
+                    print(f"ERROR occured in worker for {ncbi}: {exc}")
+
+    if first == "palindrome":
+        # one aggregation over every genome, once all of them are written
+        aggregate_palindromes(fmt)
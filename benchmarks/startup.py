@@ -0,0 +1,63 @@
+"""
+Measures the startup time of the command line tool.
+
+Runs `main.py --help` and imports of the main modules in fresh interpreters and prints
+the median wall time of every case, followed by the slowest imports reported by
+`python -X importtime`. Run from the repository root: `python benchmarks/startup.py`.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CASES = {
+    "main.py --help": [sys.executable, "main.py", "--help"],
+    "import feature": [sys.executable, "-c", "import feature"],
+    "import analysis_overlapper": [sys.executable, "-c", "import analysis_overlapper"],
+}
+
+
+def wall_time(command, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def slowest_imports(command, top):
+    """(cumulative microseconds, module) of the slowest top level imports"""
+    stderr = subprocess.run(
+        [command[0], "-X", "importtime"] + command[1:],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit() and not module.startswith("   "):
+            imports.append((int(cumulative), module.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports shown")
+    args = parser.parse_args()
+
+    for name, command in CASES.items():
+        print(f"{name:<30} {wall_time(command, args.repeat) * 1000:8.1f} ms")
+        for cumulative, module in slowest_imports(command, args.top):
+            print(f"    {module:<26} {cumulative / 1000:8.1f} ms")
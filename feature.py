@@ -1,71 +1,50 @@
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 
-from lambdas import feature_to_ncbi, ncbi_to_feature
-from out import aggregate_palindromes, palindrome_stats, stats
-from remote_api import Remote
+from analysis_io import WindowSpill, iter_analysis_chunks, read_analysis
+from ftable import FeatureTable, iter_feature_table
+from lambdas import feature_to_ncbi, ncbi_to_feature, ncbi_to_sequence
+from out import aggregate_palindromes, combined_stats, palindrome_stats, stats
+from overlap import MiddleIndex, Overlaps
+from result_cache import is_current, record_result
 from utils import _DIRS
 
+# nucleotides per spilled window and annotations per batch in chunked processing
+SPILL_WINDOW = 1_000_000
+ANNOTATION_BATCH = 1000
+# windows loaded at once in chunked processing, longer annotations are streamed
+BATCH_WINDOWS = 2
 
-class Annotation:
-    def __init__(self, start, end, type):
 
-        self.complementary = True if start > end else False
-        if self.complementary:
-            start, end = end, start
+class AnnotationTable:
+    """
+    Annotations of a feature table overlapped with one analysis.
 
-        self.start = start
-        self.end = end
-        self.type = type
-        self.len = self.end - self.start
+    Features are kept as the columns of a `FeatureTable` and the hits of feature i
+    as offset ranges into the shared arrays of an `Overlaps`, so no per-feature
+    objects or DataFrames are held.
 
-        self.info = ""
+    A `continued` table holds whole overlap groups of some of the hits of its only
+    annotation, the following tables of the same analysis hold the rest.
+    """
 
-        self.intervals = None
-        self.merged_intervals = None
+    def __init__(self, features: FeatureTable, overlaps: Overlaps, continued=False):
+        self.features = features
+        self.overlaps = overlaps
+        self.continued = continued
 
-    def set_info(self, *args):
-        if len(args) == 1:
-            self.info += f"{args[0].strip()}, "
-        else:
-            self.info += f"{args[0]} ({args[1].strip()}), "
+    def __len__(self):
+        return len(self.features)
 
 
-def process_feature_file(ncbi: str, analysis: str = "palindrome"):
-    pd.options.mode.chained_assignment = None
+def analysis_intervals(analysis_df: pd.DataFrame, analysis: str):
     """
-    Opens both feature and analysis file and processes one annotation after another
-    """
-
-    ft = open(_DIRS["features"] / f"{ncbi}.txt", "r")
-    next(ft)
-
-    annotation = None
-
-    analysis_map = {
-        "palindrome": {
-            "cols": {
-                "Position": np.int32,
-                "Length": np.int16,
-                "Spacer length": np.int16,
-            },
-            "to_drop": ["Spacer length"],
-        },
-        "g4": {
-            "cols": {"POSITION": np.int32, "LENGTH": np.int16},
-            "to_drop": ["LENGTH"],
-        },
-        "rloop": {
-            "cols": {"POSITION": np.int32, "LENGTH": np.int16},
-            "to_drop": ["LENGTH"],
-        },
-    }
-    analysis_df = pd.read_csv(
-        _DIRS[analysis] / f"{ncbi}_{analysis}.csv",
-        delimiter="\t",
-        usecols=list(analysis_map[analysis]["cols"].keys()),
-        dtype=analysis_map[analysis]["cols"],
-    )
+    Converts raw analysis columns to `start`, `end`, `middle` and `len` of every hit
+    """
+    to_drop = ["Spacer length"] if analysis == "palindrome" else ["LENGTH"]
 
     analysis_df = analysis_df.rename(
         columns={"Position" if analysis == "palindrome" else "POSITION": "start"}
@@ -87,134 +66,333 @@ def process_feature_file(ncbi: str, analysis: str = "palindrome"):
     )
     analysis_df["len"] = analysis_df["Length" if analysis == "palindrome" else "LENGTH"]
 
-    analysis_df = analysis_df.drop(columns=analysis_map[analysis]["to_drop"])
+    return analysis_df.drop(columns=to_drop)
 
-    annotations = []
 
-    for ft_line in ft:
-        split = [x.strip("<>\n") for x in ft_line.split("\t")]
-        splitlen = len(split)
+def process_feature_file(ncbi: str, analysis: str = "palindrome", chunksize=None):
+    """
+    Opens both feature and analysis file and overlaps the annotations with the analysis.
+    Annotations are parsed, processed and yielded as `AnnotationTable`s of
+    `ANNOTATION_BATCH` annotations, so writers can consume them as they come.
+    With `chunksize` set, the analysis file is streamed in chunks of that many rows.
+    """
+    for tables in process_analyses(ncbi, (analysis,), chunksize):
+        yield tables[analysis]
 
-        if splitlen in (2, 3):  # new annotation
 
-            if splitlen == 2:  # uses type from previous annotation
-                split.append(annotation.type)
+def process_analyses(ncbi: str, analyses, chunksize=None):
+    """Overlaps the annotations with several analyses in one pass over the feature table.
 
-            if (
-                annotation
-            ):  # print to csv file BUT REMEBER TO WRITE ALSO THE LAST ONE IN EOF PART
-                annotations.append(process(analysis_df, annotation))
+    Every analysis is read and indexed once, then each batch of parsed annotations is
+    overlapped with all of them, see `process_feature_file`.
 
-            annotation = Annotation(
-                start=int(split[0]), end=int(split[1]), type=split[2]
-            )
+    Args:
+        ncbi (str): NCBI ID of the processed sequence
+        analyses (tuple): analysis types to overlap
+        chunksize (int): number of analysis rows read at once, whole files if None
+
+    Yields:
+        dict: `AnnotationTable` of every analysis for one batch of annotations
+    """
+    pd.options.mode.chained_assignment = None
+    feature_file = _DIRS["features"] / f"{ncbi}.txt"
 
-        elif splitlen == 4:
-            annotation.set_info(split[3])
-        elif splitlen == 5:
-            annotation.set_info(split[3], split[4])
-        elif splitlen == 1:
-            # EOF
-            annotations.append(process(analysis_df, annotation))
-            break
+    if chunksize is not None:
+        yield from process_chunked(ncbi, analyses, feature_file, chunksize)
+        return
 
-    ft.close()
-    return annotations
+    hits = {}
+    for analysis in analyses:
+        df = analysis_intervals(read_analysis(ncbi, analysis), analysis)
+        hits[analysis] = (df, MiddleIndex(df["middle"].to_numpy()))
+    for features in iter_feature_table(feature_file, ANNOTATION_BATCH):
+        yield {
+            analysis: process(df, index, features)
+            for analysis, (df, index) in hits.items()
+        }
 
 
-def process(df: pd.DataFrame, annotation: Annotation):
-    """Processes one annotation.
-       Finds overlapping analyses for given annotation.
+def process(df: pd.DataFrame, index: MiddleIndex, features: FeatureTable):
+    """Processes a batch of annotations at once.
+       Finds overlapping analyses for every annotation with the batch overlap engine.
 
     Args:
-        df (pd.DataFrame): _description_
-        annotation (Annotation): _description_
+        df (pd.DataFrame): analysis hits with `start`, `end`, `middle` and `len` columns
+        index (MiddleIndex): index of the `middle` column of `df`
+        features (FeatureTable): annotations to overlap with the analysis hits
+
+    Returns:
+        AnnotationTable: annotations with their overlapping hits
     """
 
-    # if the middle of the palindrome is still inside annotation, we include that palindrome
-    df = df.loc[(df["middle"] >= annotation.start) & (df["middle"] <= annotation.end)]
-    if len(df > 0):
+    overlaps = Overlaps(
+        features.start,
+        features.end,
+        df["start"].to_numpy(),
+        df["end"].to_numpy(),
+        df["len"].to_numpy(),
+        index,
+    )
+    return AnnotationTable(features, overlaps)
 
-        # calculate coverage for non-overlapping palindromes
-        diff = annotation.end - annotation.start
 
-        # normalise start/end positions for overlap, but keep original start/end values for output
-        # when we have shorter annotation than last palindrome, we need to count the overlap only for
-        # the length of the annotation
-        df["cov_end"] = df["end"].apply(
-            lambda col: annotation.end if col > annotation.end else col
-        )
-        df["cov_start"] = df["start"].apply(
-            lambda col: annotation.start if annotation.start > col else col
+def process_chunked(ncbi: str, analyses, feature_file, chunksize: int):
+    """Processes all annotations without loading the whole analysis files.
+       Every analysis is read in chunks and spilled to disk by genome window. The
+       annotations of every batch are then overlapped sorted by their start, at most
+       `BATCH_WINDOWS` windows at a time, and put back in feature table order.
+       Annotations spanning more windows, e.g. the `source` of the genome, are streamed
+       `chunksize` hits at a time and their statistics are summed up by the writers.
+       Peak memory is bounded by the chunk size, `BATCH_WINDOWS` windows of hits and
+       the overlaps of one batch.
+
+    Args:
+        ncbi (str): NCBI ID of the processed sequence
+        analyses (tuple): analysis types
+        feature_file (Path): feature table to overlap with the analysis hits
+        chunksize (int): number of analysis rows read at once
+
+    Yields:
+        dict: `AnnotationTable` of every analysis for one batch, in feature table order,
+            parts of a streamed annotation come as `continued` tables of one analysis
+    """
+    _DIRS["cache"].mkdir(exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=_DIRS["cache"]) as tmp:
+        spills = {}
+        for analysis in analyses:
+            spills[analysis] = WindowSpill(tempfile.mkdtemp(dir=tmp), SPILL_WINDOW)
+            for chunk in iter_analysis_chunks(ncbi, analysis, chunksize):
+                spills[analysis].add(analysis_intervals(chunk, analysis), "middle")
+
+        for features in iter_feature_table(feature_file, ANNOTATION_BATCH):
+            spans = features.end // SPILL_WINDOW - features.start // SPILL_WINDOW
+            # runs of short annotations between the streamed ones
+            bounds = [-1] + np.flatnonzero(spans >= BATCH_WINDOWS).tolist()
+            bounds.append(len(features))
+            for first, last in zip(bounds[:-1], bounds[1:]):
+                if last - first > 1:
+                    batch = features.slice(first + 1, last)
+                    yield {
+                        analysis: _process_windows(spill, batch)
+                        for analysis, spill in spills.items()
+                    }
+                if last < len(features):
+                    feature = features.slice(last, last + 1)
+                    for analysis, spill in spills.items():
+                        for table in _stream_annotation(spill, feature, chunksize):
+                            yield {analysis: table}
+
+
+def _process_windows(spill: WindowSpill, features: FeatureTable):
+    """
+    Overlaps annotations spanning at most `BATCH_WINDOWS` windows with spilled hits.
+    Annotations are taken sorted by start in groups loading at most `BATCH_WINDOWS`
+    windows, their overlaps are joined back in the order of `features`.
+    """
+    order = np.argsort(features.start, kind="stable")
+    first = (features.start // SPILL_WINDOW)[order].tolist()
+    last = (features.end // SPILL_WINDOW)[order].tolist()
+
+    parts = []
+    low = 0
+    while low < len(order):
+        high, top = low + 1, last[low]
+        while high < len(order) and max(top, last[high]) - first[low] < BATCH_WINDOWS:
+            top = max(top, last[high])
+            high += 1
+        group = order[low:high]
+        df = spill.load(range(first[low], top + 1))
+        parts.append(
+            Overlaps(
+                features.start[group],
+                features.end[group],
+                df["start"].to_numpy(),
+                df["end"].to_numpy(),
+                df["len"].to_numpy(),
+                MiddleIndex(df["middle"].to_numpy()),
+            )
         )
+        low = high
 
-        df["coverage"] = (df.loc[:, "cov_end"] - df.loc[:, "cov_start"]) / diff * 100.0
-        annotation.intervals = df
+    return AnnotationTable(features, Overlaps.join(parts, np.argsort(order)))
 
-        # new dataframe
-        df["overlap_group"] = (df["start"] > df["end"].shift()).cumsum()
-        merged_df = df.groupby("overlap_group").agg({"start": "min", "end": "max"})
 
-        # calculate cov for overlapping palindromes
-        # same normalisation process
-        merged_df["cov_end"] = merged_df["end"].apply(
-            lambda col: annotation.end if col > annotation.end else col
-        )
-        merged_df["cov_start"] = merged_df["start"].apply(
-            lambda col: annotation.start if annotation.start > col else col
-        )
+def _stream_annotation(spill: WindowSpill, feature: FeatureTable, size: int):
+    """Overlaps one long annotation with spilled hits, streamed `size` rows at a time.
 
-        merged_df["len"] = merged_df.loc[:, "cov_end"] - merged_df.loc[:, "cov_start"]
-        merged_df["coverage"] = merged_df["len"] / diff * 100.0
-        annotation.merged_intervals = merged_df
+    Hits are kept in file order and cut only where an overlap group starts, the hits
+    of the last group wait for the next rows, so every table holds whole groups.
 
-    return annotation
+    Yields:
+        AnnotationTable: `continued` tables with parts of the hits, the last one is not
+    """
+    start, end = int(feature.start[0]), int(feature.end[0])
+    windows = range(start // SPILL_WINDOW, end // SPILL_WINDOW + 1)
+    carry = spill.load(())
+
+    for df in spill.stream(windows, size):
+        middle = df["middle"].to_numpy()
+        df = pd.concat([carry, df[(middle >= start) & (middle <= end)]])
+        hit_start = df["start"].to_numpy()
+        hit_end = df["end"].to_numpy()
+        groups = np.flatnonzero(hit_start[1:] > hit_end[:-1]) + 1
+        cut = groups[-1] if len(groups) else 0
+        carry = df.iloc[cut:]
+        if cut:
+            part = df.iloc[:cut]
+            yield AnnotationTable(
+                feature,
+                process(part, MiddleIndex(part["middle"].to_numpy()), feature).overlaps,
+                continued=True,
+            )
 
+    yield process(carry, MiddleIndex(carry["middle"].to_numpy()), feature)
 
-def overlap_with_annotations(analysis: str, ncbi_arg):
-    iter_object = (
-        _DIRS["features"].iterdir()
-        if ncbi_arg is None
-        else [ncbi_to_feature(x) for x in ncbi_arg]
-    )
-    dirnum = len(list(_DIRS["features"].glob("*.txt")))
 
-    # go annotation after annotation in annotations directory
-    for ix, annotation_file in enumerate(iter_object, start=1):
-        # convert in case of an object
+def process_genome(
+    analyses, annotation_file, ix: int, total: int, chunksize=None, fmt="xlsx"
+):
+    """Downloads missing inputs of one genome, overlaps them and writes its results.
+       Runs either in the main process or in a pool worker, so the progress is
+       collected and returned instead of printed. Several analyses are overlapped
+       in one pass and written as one combined result.
 
-        ncbi = feature_to_ncbi(annotation_file)
-        api = Remote(ncbi)
+    Returns:
+        list: progress messages of this genome
+    """
+    log = []
+    ncbi = feature_to_ncbi(annotation_file)
 
-        analysis_file = _DIRS[analysis] / f"{ncbi}_{analysis}.csv"
+    analysis_files = {
+        analysis: _DIRS[analysis] / f"{ncbi}_{analysis}.csv" for analysis in analyses
+    }
 
-        try:
-            if not annotation_file.is_file():
-                print(
-                    f"Feature file {annotation_file} doesn't exist! Downloading the file for NCBI {ncbi}"
-                )
-                if not api.get_annotation_file():
-                    print(f"Unable to download and process {ncbi} annotation.")
-                    continue
+    try:
+        if not annotation_file.is_file() or not all(
+            path.is_file() for path in analysis_files.values()
+        ):
+            # the HTTP client is loaded only when something has to be downloaded
+            from remote_api import Remote
+
+            api = Remote(ncbi)
+        if not annotation_file.is_file():
+            log.append(
+                f"Feature file {annotation_file} doesn't exist! Downloading the file for NCBI {ncbi}"
+            )
+            if not api.get_annotation_file():
+                log.append(f"Unable to download and process {ncbi} annotation.")
+                return log
+        for analysis, analysis_file in analysis_files.items():
             if not analysis_file.is_file():
-                print(
+                log.append(
                     f"Feature file {annotation_file} doesn't have matching {analysis} file in `{analysis}` folder! Downloading the file for NCBI {ncbi}"
                 )
                 if not api.get_analysis(analysis):
-                    print(f"Unable to download and process analysis file.")
-                    continue
-        except Exception as exc:
-            print(f"ERROR occured during download: {exc}")
-
-        print(f"=== Analysing batch {ncbi} ... ({ix} / {len(iter_object)}) ===")
-        if len(list(_DIRS["results"].glob(f"{ncbi}.xlsx"))) > 0:
-            print(f"\tFeature {ncbi} already processed in results folder. Skipping...")
-            continue
-        features = process_feature_file(ncbi, analysis=analysis)
-        palindrome_stats(features, ncbi) if analysis == "palindrome" else stats(
-            features, ncbi, analysis
+                    log.append(f"Unable to download and process analysis file.")
+                    return log
+    except Exception as exc:
+        log.append(f"ERROR occured during download: {exc}")
+        return log
+
+    log.append(f"=== Analysing batch {ncbi} ... ({ix} / {total}) ===")
+    if is_current(ncbi, analyses, fmt):
+        log.append(
+            f"\tFeature {ncbi} already processed from the same inputs in results folder. Skipping..."
         )
+        return log
 
-    if analysis == "palindrome":
+    try:
+        if len(analyses) > 1:
+            combined_stats(
+                process_analyses(ncbi, analyses, chunksize), ncbi, analyses, fmt
+            )
+        else:
+            (analysis,) = analyses
+            tables = process_feature_file(ncbi, analysis=analysis, chunksize=chunksize)
+            (
+                palindrome_stats(tables, ncbi, fmt)
+                if analysis == "palindrome"
+                else stats(tables, ncbi, analysis, fmt)
+            )
+        record_result(ncbi, analyses)
+    except Exception as exc:
+        log.append(f"ERROR occured while processing {ncbi}: {exc}")
+
+    return log
+
+
+def prefetch_inputs(ncbis, downloads=8, analyses=()):
+    """
+    downloads missing sequences, feature tables and automated analyses of all given
+    NCBI IDs up front, concurrently
+    """
+    missing = {
+        analysis: [
+            ncbi
+            for ncbi in ncbis
+            if not (_DIRS[analysis] / f"{ncbi}_{analysis}.csv").is_file()
+        ]
+        for analysis in analyses
+    }
+    if all(
+        ncbi_to_feature(ncbi).is_file() and ncbi_to_sequence(ncbi).is_file()
+        for ncbi in ncbis
+    ) and not any(missing.values()):
+        return
+    # the HTTP client is loaded only when something has to be downloaded
+    from remote_api import AUTOMATED_ANALYSES, fetch_analyses, prefetch
+
+    prefetch(ncbis, downloads)
+    for analysis, todo in missing.items():
+        # the rest is reported for every genome by its own download
+        if todo and analysis in AUTOMATED_ANALYSES:
+            fetch_analyses(analysis, todo, downloads)
+
+
+def overlap_with_annotations(
+    analyses,
+    ncbi_arg,
+    chunksize=None,
+    jobs=1,
+    fmt="xlsx",
+    downloads=8,
+    aggregate=True,
+):
+    """
+    overlaps the features of every genome with the given analyses, several analyses
+    are overlapped in one pass and written as one combined result per genome;
+    pool workers pass `aggregate=False` and leave the overall palindrome file
+    to their parent
+    """
+    annotation_files = (
+        sorted(_DIRS["features"].glob("*.txt"))
+        if ncbi_arg is None
+        else [ncbi_to_feature(x) for x in ncbi_arg]
+    )
+    total = len(annotation_files)
+
+    if ncbi_arg is not None:
+        prefetch_inputs(ncbi_arg, downloads, analyses=analyses)
+
+    # go annotation after annotation in annotations directory
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [
+                pool.submit(process_genome, analyses, file, ix, total, chunksize, fmt)
+                for ix, file in enumerate(annotation_files, start=1)
+            ]
+            # report progress in the submission order
+            for file, future in zip(annotation_files, futures):
+                try:
+                    log = future.result()
+                except Exception as exc:
+                    log = [f"ERROR occured in worker for {file}: {exc}"]
+                print("\n".join(log))
+    else:
+        for ix, file in enumerate(annotation_files, start=1):
+            print("\n".join(process_genome(analyses, file, ix, total, chunksize, fmt)))
+
+    if aggregate and "palindrome" in analyses:
         # aggregate files togehtehr only in case of palindrome analysis
-        aggregate_palindromes()
+        aggregate_palindromes(fmt)
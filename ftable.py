@@ -0,0 +1,123 @@
+import numpy as np
+
+
+class FeatureTable:
+    """
+    Features of an NCBI 5-column feature table (`rettype=ft`) stored as columns.
+
+    `start` <= `end` for every feature, `complementary` marks features given in reverse,
+    `type_codes` index into `types`, and the info of feature i is
+    `info[info_offsets[i] : info_offsets[i + 1]]` of one shared string buffer.
+    """
+
+    def __init__(self, start, end, complementary, type_codes, types, info, offsets):
+        self.start = start
+        self.end = end
+        self.complementary = complementary
+        self.type_codes = type_codes
+        self.types = types
+        self.info = info
+        self.info_offsets = offsets
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def type_names(self):
+        return np.asarray(self.types, dtype=object)[self.type_codes]
+
+    def slice(self, first: int, last: int):
+        """features [first, last) as a new table sharing the info buffer"""
+        return FeatureTable(
+            start=self.start[first:last],
+            end=self.end[first:last],
+            complementary=self.complementary[first:last],
+            type_codes=self.type_codes[first:last],
+            types=self.types,
+            info=self.info,
+            offsets=self.info_offsets[first : last + 1],
+        )
+
+    def info_column(self):
+        offsets = self.info_offsets.tolist()
+        return [self.info[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def _table(starts, ends, codes, types, info, offsets):
+    start = np.array(starts, dtype=np.int64)
+    end = np.array(ends, dtype=np.int64)
+
+    return FeatureTable(
+        start=np.minimum(start, end),
+        end=np.maximum(start, end),
+        complementary=start > end,
+        type_codes=np.array(codes, dtype=np.int32),
+        types=list(types),
+        info="".join(info),
+        offsets=np.array(offsets, dtype=np.int64),
+    )
+
+
+def iter_feature_table(path, batch=None):
+    """Parses an NCBI feature table lazily.
+
+    Lines with 2 or 3 columns start a new feature (2 columns reuse the previous type),
+    qualifier lines with 4 or 5 columns are appended to the feature info as `value, `
+    or `key (value), `. The first line is the `>Feature` header, a line without
+    any tab ends the table. A file without the header, e.g. an empty or broken
+    download, raises ValueError.
+
+    Args:
+        path (Path): path to the feature table
+        batch (int): maximum number of features per yielded table, unlimited if None
+
+    Yields:
+        FeatureTable: consecutive batches of features in file order
+    """
+    type_map = {}
+    starts, ends, codes, info, offsets = [], [], [], [], []
+    info_len = 0
+    last_code = None
+
+    with open(path, "r") as ft:
+        if not next(ft, "").startswith(">Feature"):
+            raise ValueError(f"{path} is not an NCBI feature table")
+
+        for line in ft:
+            fields = line[:-1].split("\t") if line[-1:] == "\n" else line.split("\t")
+            n = len(fields)
+
+            if n == 5:
+                part = f"{fields[3].strip('<>')} ({fields[4].strip('<>').strip()}), "
+            elif n == 4:
+                part = f"{fields[3].strip('<>').strip()}, "
+            elif n in (2, 3):  # new feature
+                if batch is not None and len(starts) == batch:
+                    offsets.append(info_len)
+                    yield _table(starts, ends, codes, type_map, info, offsets)
+                    starts, ends, codes, info, offsets = [], [], [], [], []
+                    info_len = 0
+
+                if n == 3:
+                    last_code = type_map.setdefault(
+                        fields[2].strip("<>"), len(type_map)
+                    )
+                elif last_code is None:  # no previous feature to take the type from
+                    last_code = type_map.setdefault("", len(type_map))
+                starts.append(int(fields[0].strip("<>")))
+                ends.append(int(fields[1].strip("<>")))
+                codes.append(last_code)
+                offsets.append(info_len)
+                continue
+            elif n == 1:  # EOF
+                break
+            else:
+                continue
+
+            if offsets:
+                info.append(part)
+                info_len += len(part)
+
+    if starts or batch is None:
+        offsets.append(info_len)
+        yield _table(starts, ends, codes, type_map, info, offsets)
@@ -1,19 +1,11 @@
 import argparse
-from pathlib import Path
-
-from analysis_overlapper import overlap_analysis_files
-from feature import overlap_with_annotations
-from lambdas import (
-    feature_to_ncbi,
-    ncbi_to_feature,
-    ncbi_to_palindrome,
-    ncbi_to_sequence,
-    palindrome_to_ncbi,
-)
-from out import aggregate_palindromes, palindrome_stats, stats
-from remote_api import Remote
+import importlib.util
+
 from utils import _DIRS, check_dirs
 
+# heavy modules (pandas, matplotlib, requests) are imported only on the code path
+# that needs them, so `--help` and argument errors return immediately
+
 if __name__ == "__main__":
 
     # process cmd args
@@ -42,14 +34,99 @@ if __name__ == "__main__":
             -c g4 ... compares g4hunter analyses to features
         """,
     )
+    parser.add_argument(
+        "--features",
+        action="store_true",
+        help="Overlap every --cmp analysis with the features in one pass and write one combined result per genome",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Stream analysis files in chunks of this many rows instead of loading them whole. Use for huge analysis files",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of genomes processed or compared in parallel",
+    )
+    parser.add_argument(
+        "--downloads",
+        type=int,
+        default=8,
+        help="Number of missing genomes downloaded concurrently before the analysis starts",
+    )
+    parser.add_argument(
+        "--format",
+        "-f",
+        type=str,
+        default="xlsx",
+        choices=["xlsx", "parquet", "both"],
+        help="Output format of the result tables. Parquet output requires the `pyarrow` package",
+    )
+    parser.add_argument(
+        "--bins",
+        type=int,
+        default=100,
+        help="Number of genome bins of the heatmaps made when comparing two analyses",
+    )
+    parser.add_argument(
+        "--plots",
+        type=str,
+        default="publication",
+        choices=["none", "fast", "publication"],
+        help="Plots made when comparing two analyses: none, fast low resolution previews or full resolution figures",
+    )
+    parser.add_argument(
+        "--render",
+        action="store_true",
+        help="Only render the plots of already compared analyses from the results folder",
+    )
     args = parser.parse_args()
 
+    if args.bins < 1:
+        parser.error("--bins must be at least 1")
+
+    if args.downloads < 1:
+        parser.error("--downloads must be at least 1")
+
+    if args.format != "xlsx" and importlib.util.find_spec("pyarrow") is None:
+        parser.error(f"--format {args.format} requires the `pyarrow` package")
+
     # create dirs if they do not exist
     check_dirs(_DIRS)
 
-    if len(args.cmp) == 2 and args.ncbi:
-        # compare two analyses
+    if args.render:
+        if len(args.cmp) != 2 or not args.ncbi or args.plots == "none":
+            parser.error("--render needs two --cmp analyses, --ncbi and --plots")
+        from plots import render_comparison
+
         for ncbi in args.ncbi:
-            overlap_analysis_files(args.cmp[0], args.cmp[1], ncbi)
+            render_comparison(args.cmp[0], args.cmp[1], ncbi, args.plots)
+    elif len(args.cmp) == 2 and args.ncbi and not args.features:
+        # compare two analyses
+        from analysis_overlapper import overlap_analyses
+
+        overlap_analyses(
+            args.cmp[0],
+            args.cmp[1],
+            args.ncbi,
+            chunksize=args.chunksize,
+            jobs=args.jobs,
+            fmt=args.format,
+            bins=args.bins,
+            plots=args.plots,
+            downloads=args.downloads,
+        )
     else:
-        overlap_with_annotations(args.cmp[0], args.ncbi)
+        from feature import overlap_with_annotations
+
+        overlap_with_annotations(
+            tuple(dict.fromkeys(args.cmp)) if args.features else (args.cmp[0],),
+            args.ncbi,
+            chunksize=args.chunksize,
+            jobs=args.jobs,
+            fmt=args.format,
+            downloads=args.downloads,
+        )
@@ -1,491 +1,905 @@
+import glob
+import json
+import re
+import shutil
+import tempfile
+from contextlib import ExitStack
+
+import numpy as np
 import pandas as pd
 import xlsxwriter
 
-from utils import _DIRS
+from accumulator import FeatureTypeStats
+from overlap import segment_reduce
+from utils import _CSV_HEADERS, _DIRS, atomic_path
+
+_MERGED_HEADERS = [
+    "Feature",
+    "Feature count",
+    "Total feature length",
+    "Palindromes count all",
+    "Palindromes count 8+",
+    "Palindromes count 10+",
+    "Palindromes count 12+",
+    "Average coverage all IRs - merged overlapping IRs",
+    "Average coverage all IRs - non-overlapping IRs",
+    "Average coverage IR 8+ - merged overlapping IRs",
+    "Average coverage IR 8+ - non-overlapping IRs",
+    "Average coverage IR 10+ - merged overlapping IRs",
+    "Average coverage IR 10+ - non-overlapping IRs",
+    "Average coverage IR 12+ - merged overlapping IRs",
+    "Average coverage IR 12+ - non-overlapping IRs",
+]
+
+# rows of one Parquet row group, buffered per sheet before they are written
+PARQUET_ROW_GROUP = 65_536
+
+# cached merged feature rows of all genomes, see `load_summaries`
+_SUMMARY_INDEX = _DIRS["results"] / "overall.summary.json"
+
+
+def parquet_path(ncbi: str, sheet: str):
+    """Parquet file holding the given result sheet, e.g. `NC_000913.3.merged_features.parquet`"""
+    slug = re.sub(r"\W+", "_", sheet).strip("_").lower()
+    return _DIRS["results"] / f"{ncbi}.{slug}.parquet"
+
+
+def result_exists(ncbi: str, analyses, fmt: str = "xlsx"):
+    """whether results of the given NCBI ID and analyses are present in the given output format"""
+    paths = []
+    if fmt in ("xlsx", "both"):
+        paths.append(_DIRS["results"] / f"{ncbi}.xlsx")
+    if fmt in ("parquet", "both"):
+        paths += [
+            parquet_path(ncbi, f"Feature to {analysis}s") for analysis in analyses
+        ]
+    return all(path.is_file() for path in paths)
+
+
+def read_result(ncbi: str, sheet):
+    """Reads one result sheet of the given NCBI ID.
+
+    The Parquet file of the sheet is preferred, the xlsx workbook is read only
+    for results written without Parquet output. A run writing a single format
+    removes the files of the other one, see `ResultWriter`, so both never
+    hold results of different runs.
+
+    Args:
+        ncbi (str): NCBI ID of the processed sequence
+        sheet (str): name of the result sheet, e.g. `Merged features`
+
+    Returns:
+        pd.DataFrame: the sheet with its header row as column names
+    """
+    path = parquet_path(ncbi, sheet)
+    if path.is_file():
+        return pd.read_parquet(path)
+    return pd.read_excel(_DIRS["results"] / f"{ncbi}.xlsx", sheet_name=sheet)
+
+
+def _stale_results(ncbi: str, fmt: str):
+    """result files of the given NCBI ID in the formats `fmt` does not write"""
+    paths = []
+    if fmt == "parquet":
+        paths.append(_DIRS["results"] / f"{ncbi}.xlsx")
+    if fmt == "xlsx":
+        name = re.compile(rf"{re.escape(ncbi)}\.\w+\.parquet")
+        paths += [
+            path
+            for path in _DIRS["results"].glob(f"{glob.escape(ncbi)}.*.parquet")
+            if name.fullmatch(path.name)
+        ]
+    return [path for path in paths if path.is_file()]
+
+
+class ResultWriter:
+    """
+    Writes the result sheets of one genome as an xlsx workbook, as one Parquet file
+    per sheet, or both. Rows are streamed into the workbook and into Parquet row groups
+    of `PARQUET_ROW_GROUP` rows, every file is moved into place only once all of them
+    were written successfully. Result files of the genome in the format that was not
+    written are removed then, they belong to an earlier run.
+    """
+
+    def __init__(self, ncbi: str, fmt: str = "xlsx"):
+        self.ncbi = ncbi
+        self.fmt = fmt
+        self.xlsx = fmt in ("xlsx", "both")
+        self.parquet = fmt in ("parquet", "both")
+        self.sheets = {}
+        self.workbook = None
+        self._paths = ExitStack()
+
+    def __enter__(self):
+        if self.xlsx:
+            tmp = self._paths.enter_context(
+                atomic_path(_DIRS["results"] / f"{self.ncbi}.xlsx")
+            )
+            self.workbook = xlsxwriter.Workbook(
+                tmp, {"nan_inf_to_errors": True, "constant_memory": True}
+            )
+            self.bold = self.workbook.add_format({"bold": True})
+        return self
+
+    def add_sheet(self, name: str, headers, types, widths=()):
+        """
+        adds a sheet with the given headers and Python types (`str`, `int` or `float`)
+        of its columns, `widths` are `(first, last, width)` column ranges
+        """
+        ws = None
+        if self.workbook is not None:
+            ws = self.workbook.add_worksheet(name)
+            for first, last, width in widths:
+                ws.set_column(first, last, width)
+            ws.write_row(0, 0, headers, self.bold)
+        writer = None
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            arrow_types = {str: pa.large_string(), int: pa.int64(), float: pa.float64()}
+            schema = pa.schema(
+                [(header, arrow_types[type]) for header, type in zip(headers, types)]
+            )
+            tmp = self._paths.enter_context(atomic_path(parquet_path(self.ncbi, name)))
+            writer = pq.ParquetWriter(tmp, schema)
+            # closed before the file is moved into place
+            self._paths.callback(writer.close)
+        self.sheets[name] = {"ws": ws, "writer": writer, "rows": [], "rownum": 1}
+
+    def write_row(self, name: str, row):
+        sheet = self.sheets[name]
+        if sheet["ws"] is not None:
+            sheet["ws"].write_row(sheet["rownum"], 0, row)
+        if sheet["writer"] is not None:
+            sheet["rows"].append(row)
+            if len(sheet["rows"]) >= PARQUET_ROW_GROUP:
+                self._flush(sheet)
+        sheet["rownum"] += 1
+
+    def _flush(self, sheet):
+        """writes the buffered rows of a sheet as one Parquet row group"""
+        import pyarrow as pa
+
+        writer = sheet["writer"]
+        width = len(writer.schema)
+        # rows without statistics are shorter, their missing cells are null
+        rows = [[*row, *[None] * (width - len(row))] for row in sheet["rows"]]
+        writer.write_table(
+            pa.Table.from_arrays(
+                [
+                    pa.array(column, type=field.type)
+                    for column, field in zip(zip(*rows), writer.schema)
+                ],
+                schema=writer.schema,
+            )
+        )
+        sheet["rows"] = []
+
+    def _close(self):
+        if self.workbook is not None:
+            self.workbook.close()
+        for sheet in self.sheets.values():
+            if sheet["rows"]:
+                self._flush(sheet)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            return self._paths.__exit__(exc_type, exc, tb)
+        with self._paths:
+            self._close()
+        for path in _stale_results(self.ncbi, self.fmt):
+            path.unlink()
+
+
+def _hit_lines(start, end, coverage):
+    """report lines of all hits, formatted in one pass over plain Python values"""
+    return list(
+        map(
+            "\t%d - %d\t%.2f%%\n".__mod__,
+            zip(start.tolist(), end.tolist(), coverage.tolist()),
+        )
+    )
 
 
-def palindrome_stats(features, ncbi):
+def _segment_nansum(values, offsets):
+    """
+    `np.nansum` of every slice [offsets[i], offsets[i + 1]), reduced slice by slice so the
+    digits match pandas `sum` of the same values, a bulk `np.add.reduceat` rounds differently
+    """
+    sums = np.zeros(len(offsets) - 1)
+    for ix in np.flatnonzero(np.diff(offsets)).tolist():
+        sums[ix] = np.nansum(values[offsets[ix] : offsets[ix + 1]])
+    return sums
 
-    txt = open(_DIRS["results"] / f"{ncbi}.txt", "w")
 
-    workbook = xlsxwriter.Workbook(
-        _DIRS["results"] / f"{ncbi}.xlsx", {"nan_inf_to_errors": True}
-    )
-    ws_solo = workbook.add_worksheet("Feature to palindromes")
-    ws_merged = workbook.add_worksheet("Merged features")
-    bold = workbook.add_format({"bold": True})
-
-    ws_solo.set_column(0, 0, 10)
-    ws_solo.set_column(1, 1, 40)
-    ws_solo.set_column(2, 4, 15)
-    ws_solo.set_column(4, 8, 23)
-    ws_solo.set_column(8, 16, 50)
-
-    ws_merged.set_column(0, 6, 23)
-    ws_merged.set_column(6, 15, 50)
-
-    # add headers for xlsx file
-    headers_solo = {
-        "A1": "Feature",
-        "B1": "Info",
-        "C1": "Feature start",
-        "D1": "Feature end",
-        "E1": "Feature size",
-        "F1": "Palindromes count",
-        "G1": "Palindromes count 8+",
-        "H1": "Palindromes count 10+",
-        "I1": "Palindromes count 12+",
-        "J1": "Average coverage all IRs - merged overlapping IRs",
-        "K1": "Average coverage all IRs - non-overlapping IRs",
-        "L1": "Average coverage IR 8+ - merged overlapping IRs",
-        "M1": "Average coverage IR 8+ - non-overlapping IRs",
-        "N1": "Average coverage IR 10+ - merged overlapping IRs",
-        "O1": "Average coverage IR 10+ - non-overlapping IRs",
-        "P1": "Average coverage IR 12+ - merged overlapping IRs",
-        "Q1": "Average coverage IR 12+ - non-overlapping IRs",
-    }
-    headers_merged = {
-        "A1": "Feature",
-        "B1": "Feature count",
-        "C1": "Total feature length",
-        "D1": "Palindromes count all",
-        "E1": "Palindromes count 8+",
-        "F1": "Palindromes count 10+",
-        "G1": "Palindromes count 12+",
-        "H1": "Average coverage all IRs - merged overlapping IRs",
-        "I1": "Average coverage all IRs - non-overlapping IRs",
-        "J1": "Average coverage IR 8+ - merged overlapping IRs",
-        "K1": "Average coverage IR 8+ - non-overlapping IRs",
-        "L1": "Average coverage IR 10+ - merged overlapping IRs",
-        "M1": "Average coverage IR 10+ - non-overlapping IRs",
-        "N1": "Average coverage IR 12+ - merged overlapping IRs",
-        "O1": "Average coverage IR 12+ - non-overlapping IRs",
-    }
-    for index, name in headers_solo.items():
-        ws_solo.write(index, name, bold)
+def _segments(values, offsets, mask=None):
+    """Per-segment size, non-NaN count and NaN-skipping sum of `values`.
 
-    for index, name in headers_merged.items():
-        ws_merged.write(index, name, bold)
+    Their means give the same numbers as pandas `len`, `count` and `mean` on every
+    slice [offsets[i], offsets[i + 1]), restricted to the rows selected by `mask`.
+    """
+    if mask is not None:
+        offsets = np.concatenate(([0], np.cumsum(mask)))[offsets]
+        values = values[mask]
 
-    merged_feature_data = {}
+    valid = ~np.isnan(values)
+    size = np.diff(offsets)
+    count = segment_reduce(np.add, valid.astype(np.int64), offsets)
+    sums = segment_reduce(np.add, np.where(valid, values, 0.0), offsets)
 
-    # General statisctics
-    txt.write(f"ANNOTATION STATISTICS: {ncbi}\n")
-    txt.write(f"==================\n\n")
+    return size, count, sums
 
-    for rownum, feat in enumerate(features, start=1):
-        txt.write(f"Feature: {feat.start} - {feat.end} ({feat.type})\n")
 
-        # xlsx feature info
-        ws_solo.write(rownum, 0, feat.type)
-        ws_solo.write(rownum, 1, feat.info)
-        ws_solo.write(rownum, 2, feat.start)
-        ws_solo.write(rownum, 3, feat.end)
-        ws_solo.write(rownum, 4, feat.end - feat.start)
+def _mean(sums, count):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return sums / count
 
-        # non-overlapping
-        txt.write("\t<palindromes>	<palindrome-to-feature-ratio>\n")
-        if feat.intervals is not None:
 
-            # xlsx palindrome info
+# per-feature sums of the parts of one annotation combined otherwise than by adding
+_PIECE_REDUCE = {
+    "low": np.minimum,
+    "high": np.maximum,
+    "merged low": np.minimum,
+    "merged high": np.maximum,
+}
 
-            p_all_cov_non = feat.intervals["coverage"]
-            p8_cov_non = feat.intervals.loc[feat.intervals["len"] >= 8]["coverage"]
-            p10_cov_non = feat.intervals.loc[feat.intervals["len"] >= 10]["coverage"]
-            p12_cov_non = feat.intervals.loc[feat.intervals["len"] >= 12]["coverage"]
 
-            ws_solo.write(rownum, 5, p_all_cov_non.count())
-            ws_solo.write(rownum, 6, p8_cov_non.count())
-            ws_solo.write(rownum, 7, p10_cov_non.count())
-            ws_solo.write(rownum, 8, p12_cov_non.count())
+def _add_sums(total, sums):
+    """adds the per-feature sums of the next part of the same annotations to `total`"""
+    for key, values in sums.items():
+        total[key] = _PIECE_REDUCE.get(key, np.add)(total[key], values)
 
-            ws_solo.write(
-                rownum, 10, p_all_cov_non.mean() if not p_all_cov_non.empty else 0.0
-            )
-            ws_solo.write(
-                rownum, 12, p8_cov_non.mean() if not p8_cov_non.empty else 0.0
-            )
-            ws_solo.write(
-                rownum, 14, p10_cov_non.mean() if not p10_cov_non.empty else 0.0
-            )
-            ws_solo.write(
-                rownum, 16, p12_cov_non.mean() if not p12_cov_non.empty else 0.0
-            )
 
-            for _, row in feat.intervals.iterrows():
-                txt.write(
-                    "\t%d - %d\t%.2f%%\n" % (row["start"], row["end"], row["coverage"])
-                )
+def _palindrome_sums(table):
+    """Per-feature sums of one `AnnotationTable` behind `_palindrome_columns`"""
+    ov = table.overlaps
+    sums = {
+        "hits": ov.hit_counts,
+        "merged hits": ov.merged_counts,
+        "nansum": _segment_nansum(ov.coverage, ov.offsets),
+        "merged nansum": _segment_nansum(ov.merged_coverage, ov.merged_offsets),
+    }
+
+    for threshold in (0, 8, 10, 12):
+        (
+            sums[f"size {threshold}"],
+            sums[f"count {threshold}"],
+            sums[f"non {threshold}"],
+        ) = _segments(ov.coverage, ov.offsets, ov.len >= threshold)
+        (
+            sums[f"merged size {threshold}"],
+            sums[f"merged count {threshold}"],
+            sums[f"merged {threshold}"],
+        ) = _segments(ov.merged_coverage, ov.merged_offsets, ov.merged_len >= threshold)
+
+    return sums
+
+
+def _palindrome_columns(sums):
+    """Per-feature statistics for the palindrome xlsx output, see `_palindrome_sums`"""
+    columns = {"hits": sums["hits"] > 0}
 
-            txt.write(f"\n  Palindromes in this feature: {p_all_cov_non.count()}\n")
-            txt.write(
-                f"  Total palindrome to feature ratio in this feature: {feat.intervals['coverage'].sum():.2f}%\n\n"
+    for threshold in (0, 8, 10, 12):
+        columns[f"count {threshold}"] = sums[f"count {threshold}"]
+        columns[f"non {threshold}"] = np.where(
+            sums[f"size {threshold}"] > 0,
+            _mean(sums[f"non {threshold}"], sums[f"count {threshold}"]),
+            0.0,
+        )
+        columns[f"merged {threshold}"] = np.where(
+            sums[f"merged size {threshold}"] > 0,
+            _mean(sums[f"merged {threshold}"], sums[f"merged count {threshold}"]),
+            0.0,
+        )
+
+    return columns
+
+
+_REPORT_HEADER = "Feature: {start} - {end} ({type})\n\t<{analysis}s>\t<{analysis}-to-feature-ratio>\n"
+_REPORT_MERGED_HEADER = (
+    "\t<{analysis}s>\t<{analysis}-to-feature-ratio> (merged-overlap)\n"
+)
+_REPORT_FOOTER = (
+    "\n  {name}s in this feature: {count}{merged}\n"
+    "  Total {analysis} to feature ratio in this feature: {ratio:.2f}%{merged}\n\n"
+)
+
+
+def _report(table, analysis, types, starts, ends, counts, ratios, merged_ratios):
+    """detail text report of one `AnnotationTable`, built as a single string"""
+    ov = table.overlaps
+    name = analysis.capitalize()
+    offsets = ov.offsets.tolist()
+    merged_offsets = ov.merged_offsets.tolist()
+    lines = _hit_lines(ov.start, ov.end, ov.coverage)
+    merged_lines = _hit_lines(ov.merged_start, ov.merged_end, ov.merged_coverage)
+    merged_header = _REPORT_MERGED_HEADER.format(analysis=analysis)
+
+    report = []
+    for ix, (type, start, end) in enumerate(zip(types, starts, ends)):
+        report.append(
+            _REPORT_HEADER.format(start=start, end=end, type=type, analysis=analysis)
+        )
+
+        # non-overlapping
+        a, b = offsets[ix], offsets[ix + 1]
+        if a < b:
+            report += lines[a:b]
+            report.append(
+                _REPORT_FOOTER.format(
+                    name=name,
+                    analysis=analysis,
+                    count=counts[ix],
+                    ratio=ratios[ix],
+                    merged="",
+                )
             )
 
         # merged-overlap
-        txt.write("\t<palindromes>	<palindrome-to-feature-ratio> (merged-overlap)\n")
-        if feat.merged_intervals is not None:
-
-            p_all_cov = feat.merged_intervals["coverage"]
-            p8_cov = feat.merged_intervals.loc[feat.merged_intervals["len"] >= 8][
-                "coverage"
-            ]
-            p10_cov = feat.merged_intervals.loc[feat.merged_intervals["len"] >= 10][
-                "coverage"
-            ]
-            p12_cov = feat.merged_intervals.loc[feat.merged_intervals["len"] >= 12][
-                "coverage"
-            ]
-
-            ws_solo.write(rownum, 9, p_all_cov.mean() if not p_all_cov.empty else 0.0)
-            ws_solo.write(rownum, 11, p8_cov.mean() if not p8_cov.empty else 0.0)
-            ws_solo.write(rownum, 13, p10_cov.mean() if not p10_cov.empty else 0.0)
-            ws_solo.write(rownum, 15, p12_cov.mean() if not p12_cov.empty else 0.0)
-
-            for _, row in feat.merged_intervals.iterrows():
-                txt.write(
-                    "\t%d - %d\t%.2f%%\n" % (row["start"], row["end"], row["coverage"])
+        report.append(merged_header)
+        a, b = merged_offsets[ix], merged_offsets[ix + 1]
+        if a < b:
+            report += merged_lines[a:b]
+            report.append(
+                _REPORT_FOOTER.format(
+                    name=name,
+                    analysis=analysis,
+                    count=b - a,
+                    ratio=merged_ratios[ix],
+                    merged=" (merged-overlap)",
                 )
-
-            txt.write(
-                f"\n  Palindromes in this feature: {feat.merged_intervals['start'].count()} (merged-overlap)\n"
-            )
-            txt.write(
-                f"  Total palindrome to feature ratio in this feature: {feat.merged_intervals['coverage'].sum():.2f}% (merged-overlap)\n\n"
             )
 
-            if feat.type in merged_feature_data:
-                # skip 1st - feature name
-                merged_feature_data[feat.type][1] += 1  # cnt
-                merged_feature_data[feat.type][2] += feat.end - feat.start  # len
-                merged_feature_data[feat.type][
-                    3
-                ] += p_all_cov_non.count()  # all palindromes
-                merged_feature_data[feat.type][
-                    4
-                ] += p8_cov_non.count()  # p8 palindromes
-                merged_feature_data[feat.type][
-                    5
-                ] += p10_cov_non.count()  # p10 palindromes
-                merged_feature_data[feat.type][
-                    6
-                ] += p12_cov_non.count()  # p12 palindromes
-                merged_feature_data[feat.type][7] = (
-                    merged_feature_data[feat.type][7] + p_all_cov_non.mean()
-                    if not p_all_cov_non.empty
-                    else 0.0
-                ) / 2
-                merged_feature_data[feat.type][8] = (
-                    merged_feature_data[feat.type][8] + p_all_cov.mean()
-                    if not p_all_cov.empty
-                    else 0.0
-                ) / 2
-                merged_feature_data[feat.type][9] = (
-                    merged_feature_data[feat.type][9] + p8_cov_non.mean()
-                    if not p8_cov_non.empty
-                    else 0.0
-                ) / 2
-                merged_feature_data[feat.type][10] = (
-                    merged_feature_data[feat.type][10] + p8_cov.mean()
-                    if not p8_cov.empty
-                    else 0.0
-                ) / 2
-                merged_feature_data[feat.type][11] = (
-                    merged_feature_data[feat.type][11] + p10_cov_non.mean()
-                    if not p10_cov_non.empty
-                    else 0.0
-                ) / 2
-                merged_feature_data[feat.type][12] = (
-                    merged_feature_data[feat.type][12] + p10_cov.mean()
-                    if not p10_cov.empty
-                    else 0.0
-                ) / 2
-                merged_feature_data[feat.type][13] = (
-                    merged_feature_data[feat.type][13] + p12_cov_non.mean()
-                    if not p12_cov_non.empty
-                    else 0.0
-                ) / 2
-                merged_feature_data[feat.type][14] = (
-                    merged_feature_data[feat.type][14] + p12_cov.mean()
-                    if not p12_cov.empty
-                    else 0.0
-                ) / 2
-            else:
-                merged_feature_data[feat.type] = [
-                    feat.type,
-                    1,
-                    (feat.end - feat.start),
-                    p_all_cov_non.count(),
-                    p8_cov_non.count(),
-                    p10_cov_non.count(),
-                    p12_cov_non.count(),
-                    p_all_cov_non.mean() if not p_all_cov_non.empty else 0.0,
-                    p_all_cov.mean() if not p_all_cov.empty else 0.0,
-                    p8_cov_non.mean() if not p8_cov_non.empty else 0.0,
-                    p8_cov.mean() if not p8_cov.empty else 0.0,
-                    p10_cov_non.mean() if not p10_cov_non.empty else 0.0,
-                    p10_cov.mean() if not p10_cov.empty else 0.0,
-                    p12_cov_non.mean() if not p12_cov_non.empty else 0.0,
-                    p12_cov.mean() if not p12_cov.empty else 0.0,
-                ]
+    return "".join(report)
 
-    xlsx_row_cnt = 1
-    for row in merged_feature_data.values():
-        for ix, col in enumerate(row):
-            ws_merged.write(xlsx_row_cnt, ix, col)
-        xlsx_row_cnt += 1
 
-    txt.close()
-    workbook.close()
+class _PieceReport:
+    """
+    Detail text report of one annotation whose hits come in several tables, hit lines
+    are written as they come while the merged ones wait in a temporary file
+    """
 
+    def __init__(self, txt, analysis: str, type, start, end):
+        self.txt = txt
+        self.analysis = analysis
+        self.merged = tempfile.TemporaryFile("w+")
+        txt.write(
+            _REPORT_HEADER.format(start=start, end=end, type=type, analysis=analysis)
+        )
 
-def aggregate_palindromes():
-    print("*****\nAggregating all xlsx files into the overall.xlsx file.")
-    df = pd.concat(
-        (
-            pd.read_excel(file, sheet_name=1)
-            for file in _DIRS["results"].glob("NC_*.xlsx")
+    def add(self, table):
+        ov = table.overlaps
+        self.txt.writelines(_hit_lines(ov.start, ov.end, ov.coverage))
+        self.merged.writelines(
+            _hit_lines(ov.merged_start, ov.merged_end, ov.merged_coverage)
         )
-    )
 
-    df_sum = df[
-        [
-            "Feature",
-            "Feature count",
-            "Total feature length",
-            "Palindromes count all",
-            "Palindromes count 8+",
-            "Palindromes count 10+",
-            "Palindromes count 12+",
-        ]
-    ]
+    def close(self, hits, count, ratio, merged_count, merged_ratio):
+        name = self.analysis.capitalize()
+        if hits:
+            self.txt.write(
+                _REPORT_FOOTER.format(
+                    name=name,
+                    analysis=self.analysis,
+                    count=count,
+                    ratio=ratio,
+                    merged="",
+                )
+            )
 
-    df_mean = df[
-        [
-            "Feature",
-            "Average coverage all IRs - merged overlapping IRs",
-            "Average coverage all IRs - non-overlapping IRs",
-            "Average coverage IR 8+ - merged overlapping IRs",
-            "Average coverage IR 8+ - non-overlapping IRs",
-            "Average coverage IR 10+ - merged overlapping IRs",
-            "Average coverage IR 10+ - non-overlapping IRs",
-            "Average coverage IR 12+ - merged overlapping IRs",
-            "Average coverage IR 12+ - non-overlapping IRs",
-        ]
-    ]
+        self.txt.write(_REPORT_MERGED_HEADER.format(analysis=self.analysis))
+        if merged_count:
+            self.merged.seek(0)
+            shutil.copyfileobj(self.merged, self.txt)
+            self.txt.write(
+                _REPORT_FOOTER.format(
+                    name=name,
+                    analysis=self.analysis,
+                    count=merged_count,
+                    ratio=merged_ratio,
+                    merged=" (merged-overlap)",
+                )
+            )
+        self.merged.close()
+
+
+class _FeatureSheets:
+    """
+    Common part of `PalindromeSheets` and `StatsSheets`. A long annotation may come as
+    several `continued` tables, each holding whole overlap groups of its hits, their
+    per-feature sums are added up and its row is written with the last of them.
+    """
+
+    _piece = None
+
+    def add(self, table):
+        features = table.features
+        sums = self._sums(table)
+
+        if not table.continued and self._piece is None:
+            counts, ratios, merged_ratios = self._write(features, sums)
+            self.txt.write(
+                _report(
+                    table,
+                    self.analysis,
+                    features.type_names.tolist(),
+                    features.start.tolist(),
+                    features.end.tolist(),
+                    counts,
+                    ratios,
+                    merged_ratios,
+                )
+            )
+            return
+
+        if self._piece is None:
+            (type,) = features.type_names.tolist()
+            report = _PieceReport(
+                self.txt,
+                self.analysis,
+                type,
+                int(features.start[0]),
+                int(features.end[0]),
+            )
+            self._piece = (sums, report)
+        else:
+            _add_sums(self._piece[0], sums)
+        sums, report = self._piece
+        report.add(table)
+
+        if not table.continued:
+            self._piece = None
+            counts, ratios, merged_ratios = self._write(features, sums)
+            report.close(
+                int(sums["hits"][0]),
+                counts[0],
+                ratios[0],
+                int(sums["merged hits"][0]),
+                merged_ratios[0],
+            )
 
-    df_sum = df_sum.groupby(by="Feature", as_index=False).sum()
-    df_mean = df_mean.groupby(by="Feature", as_index=False).mean()
-    df_mean = df_mean.drop(["Feature"], axis=1)
+    def close(self):
+        for row in self.merged_stats.rows():
+            self.result.write_row(self.merged_sheet, row)
 
-    workbook = xlsxwriter.Workbook(
-        _DIRS["results"] / f"overall.xlsx", {"nan_inf_to_errors": True}
-    )
-    ws = workbook.add_worksheet("Overall feature statistics")
-
-    headers = {
-        "A1": "Feature",
-        "B1": "Feature count",
-        "C1": "Total feature length",
-        "D1": "Palindromes count all",
-        "E1": "Palindromes count 8+",
-        "F1": "Palindromes count 10+",
-        "G1": "Palindromes count 12+",
-        "H1": "Average coverage all IRs - merged overlapping IRs",
-        "I1": "Average coverage all IRs - non-overlapping IRs",
-        "J1": "Average coverage IR 8+ - merged overlapping IRs",
-        "K1": "Average coverage IR 8+ - non-overlapping IRs",
-        "L1": "Average coverage IR 10+ - merged overlapping IRs",
-        "M1": "Average coverage IR 10+ - non-overlapping IRs",
-        "N1": "Average coverage IR 12+ - merged overlapping IRs",
-        "O1": "Average coverage IR 12+ - non-overlapping IRs",
-    }
-    bold = workbook.add_format({"bold": True})
 
-    ws.set_column(0, 6, 23)
-    ws.set_column(6, 15, 50)
+class PalindromeSheets(_FeatureSheets):
+    """
+    Feature and merged feature sheets of a palindrome analysis of one genome, filled
+    one `AnnotationTable` at a time while the detail report goes to `txt`
+    """
 
-    for index, name in headers.items():
-        ws.write(index, name, bold)
+    analysis = "palindrome"
 
-    # insert aggregated values
-    print("----------------------------")
-    for ir, row in enumerate(df_sum.values, start=1):
-        for ic, col in enumerate(row):
-            ws.write(ir, ic, col)  # sum stats
+    def __init__(self, result, txt, ncbi: str, merged_sheet="Merged features"):
+        self.result = result
+        self.txt = txt
+        self.merged_sheet = merged_sheet
 
-    for ir, row in enumerate(df_mean.values, start=1):
-        for ic, col in enumerate(row):
-            ws.write(ir, ic + df_sum.shape[1], col)  # mean stats
+        # counts are empty for features without palindromes, kept as floats
+        result.add_sheet(
+            "Feature to palindromes",
+            _CSV_HEADERS,
+            (str, str, int, int, int) + (float,) * 12,
+            widths=[(0, 0, 10), (1, 1, 40), (2, 4, 15), (4, 8, 23), (8, 16, 50)],
+        )
+        result.add_sheet(
+            merged_sheet,
+            _MERGED_HEADERS,
+            (str,) + (int,) * 6 + (float,) * 8,
+            widths=[(0, 6, 23), (6, 15, 50)],
+        )
 
-    workbook.close()
+        self.merged_stats = FeatureTypeStats(_MERGED_HEADERS[1:7], _MERGED_HEADERS[7:])
+
+        # General statisctics
+        txt.write(f"ANNOTATION STATISTICS: {ncbi}\n")
+        txt.write(f"==================\n\n")
+
+    def _sums(self, table):
+        return _palindrome_sums(table)
+
+    def _write(self, features, sums):
+        """writes the rows of the given features, returns the values of their report"""
+        arrays = _palindrome_columns(sums)
+        columns = {name: values.tolist() for name, values in arrays.items()}
+        starts = features.start.tolist()
+        ends = features.end.tolist()
+
+        # xlsx feature info, statistics are left empty for features without palindromes
+        for ix, (type, info, start, end, hits) in enumerate(
+            zip(
+                features.type_names.tolist(),
+                features.info_column(),
+                starts,
+                ends,
+                columns["hits"],
+            )
+        ):
+            row = [type, info, start, end, end - start]
+            if hits:
+                row += [columns[f"count {t}"][ix] for t in (0, 8, 10, 12)]
+                for t in (0, 8, 10, 12):
+                    row += [columns[f"merged {t}"][ix], columns[f"non {t}"][ix]]
+            self.result.write_row("Feature to palindromes", row)
+
+        # only features with palindromes are merged
+        hits = arrays["hits"]
+        self.merged_stats.update(
+            features.type_names[hits],
+            np.column_stack(
+                [
+                    np.ones(len(features), dtype=np.int64),
+                    features.end - features.start,
+                ]
+                + [arrays[f"count {t}"] for t in (0, 8, 10, 12)]
+            )[hits],
+            np.column_stack(
+                [
+                    arrays[f"{kind} {t}"]
+                    for t in (0, 8, 10, 12)
+                    for kind in ("merged", "non")
+                ]
+            )[hits],
+        )
 
+        return (
+            columns["count 0"],
+            sums["nansum"].tolist(),
+            sums["merged nansum"].tolist(),
+        )
 
-def stats(features, ncbi, analysis: str):
 
-    txt = open(_DIRS["results"] / f"{ncbi}.txt", "w")
+def _write_summary(ncbi: str, merged_stats):
+    with atomic_path(summary_path(ncbi)) as tmp, open(tmp, "w") as summary:
+        json.dump(merged_stats.to_dict(), summary)
 
-    workbook = xlsxwriter.Workbook(
-        _DIRS["results"] / f"{ncbi}.xlsx", {"nan_inf_to_errors": True}
-    )
-    ws_solo = workbook.add_worksheet(f"Feature to {analysis}s")
-    ws_merged = workbook.add_worksheet("Merged features")
-    bold = workbook.add_format({"bold": True})
-
-    ws_solo.set_column(0, 0, 10)
-    ws_solo.set_column(1, 1, 40)
-    ws_solo.set_column(2, 4, 15)
-    ws_solo.set_column(4, 8, 23)
-    ws_solo.set_column(8, 16, 50)
-
-    ws_merged.set_column(0, 6, 23)
-    ws_merged.set_column(6, 15, 50)
-
-    # add headers for xlsx file
-    headers_solo = {
-        "A1": "Feature",
-        "B1": "Info",
-        "C1": "Feature start",
-        "D1": "Feature end",
-        "E1": "Feature size",
-        "F1": f"{analysis.capitalize()}s count",
-        "G1": f"Average coverage all {analysis.capitalize()}s - overlapping",
-        "H1": f"Average coverage all {analysis.capitalize()}s - non-overlapping",
-        "I1": f"Overall coverage of {analysis.capitalize()}s - overlapping",
-        "J1": f"Overall coverage of {analysis.capitalize()}s - non-overlapping",
-    }
-    headers_merged = {
-        "A1": "Feature",
-        "B1": "Feature count",
-        "C1": "Total feature length",
-        "D1": f"{analysis.capitalize()}s count",
-        "E1": f"Average coverage all {analysis.capitalize()}s - overlapping",
-        "F1": f"Average coverage all {analysis.capitalize()}s - non-overlapping",
-    }
-    for index, name in headers_solo.items():
-        ws_solo.write(index, name, bold)
 
-    for index, name in headers_merged.items():
-        ws_merged.write(index, name, bold)
+def palindrome_stats(tables, ncbi, fmt="xlsx"):
 
-    merged_feature_data = {}
+    with atomic_path(_DIRS["results"] / f"{ncbi}.txt") as txt_path, ResultWriter(
+        ncbi, fmt
+    ) as result, open(txt_path, "w") as txt:
+        sheets = PalindromeSheets(result, txt, ncbi)
+        for table in tables:
+            sheets.add(table)
+        sheets.close()
 
-    # General statisctics
-    txt.write(f"ANNOTATION STATISTICS: {ncbi}\n")
-    txt.write(f"==================\n\n")
+    _write_summary(ncbi, sheets.merged_stats)
 
-    for rownum, feat in enumerate(features, start=1):
-        txt.write(f"Feature: {feat.start} - {feat.end} ({feat.type})\n")
 
-        # xlsx feature info
-        ws_solo.write(rownum, 0, feat.type)
-        ws_solo.write(rownum, 1, feat.info)
-        ws_solo.write(rownum, 2, feat.start)
-        ws_solo.write(rownum, 3, feat.end)
-        ws_solo.write(rownum, 4, feat.end - feat.start)
+def result_ncbis():
+    """NCBI IDs of all genome results in the results folder, in any output format"""
+    suffix = parquet_path("", "Merged features").name
+    ncbis = {
+        path.name[: -len(suffix)] for path in _DIRS["results"].glob(f"NC_*{suffix}")
+    }
+    ncbis.update(
+        path.name[: -len(".summary.json")]
+        for path in _DIRS["results"].glob("NC_*.summary.json")
+    )
+    # `{ncbi}_{first}_{second}.xlsx` comparison workbooks are not genome results
+    ncbis.update(
+        path.stem
+        for path in _DIRS["results"].glob("NC_*.xlsx")
+        if path.stem.count("_") == 1
+    )
+    return sorted(ncbis)
+
+
+def summary_path(ncbi: str):
+    """sidecar with the feature type statistics of one genome, read by `aggregate_palindromes`"""
+    return _DIRS["results"] / f"{ncbi}.summary.json"
+
+
+def _summary_source(ncbi: str):
+    """file the feature type statistics of a genome are read from, the sidecar if present"""
+    for path in (
+        summary_path(ncbi),
+        parquet_path(ncbi, "Merged features"),
+        _DIRS["results"] / f"{ncbi}.xlsx",
+    ):
+        if path.is_file():
+            return path
+
+
+def _summary_stats(ncbi: str, source):
+    if source.suffix == ".json":
+        with open(source) as summary:
+            data = json.load(summary)
+        if "types" in data:
+            return FeatureTypeStats.from_dict(data)
+        rows = data["rows"]
+    else:
+        # results written before sidecars existed, only their averages are known
+        try:
+            df = read_result(ncbi, "Merged features")
+        except ValueError:
+            # combined results without palindromes have no such sheet
+            return FeatureTypeStats(_MERGED_HEADERS[1:7], _MERGED_HEADERS[7:])
+        rows = df.reindex(columns=_MERGED_HEADERS).values.tolist()
+    return FeatureTypeStats.from_rows(rows, _MERGED_HEADERS[1:7], _MERGED_HEADERS[7:])
+
+
+def load_summaries():
+    """Collects the feature type statistics of every genome result.
+
+    Statistics are cached in `overall.summary.json` together with the size and mtime
+    of the file they were read from, so only genomes added or changed since the last run
+    are read again and genomes no longer present are dropped.
+
+    Returns:
+        tuple: summaries of all genomes by NCBI ID and whether any genome changed
+            since the cached summaries were saved
+    """
+    cached = {}
+    if _SUMMARY_INDEX.is_file():
+        with open(_SUMMARY_INDEX) as index:
+            cached = json.load(index)
+
+    genomes = {}
+    for ncbi in result_ncbis():
+        source = _summary_source(ncbi)
+        stat = source.stat()
+        key = f"{source.name}:{stat.st_size}:{stat.st_mtime_ns}"
+        if cached.get(ncbi, {}).get("key") == key and "stats" in cached[ncbi]:
+            genomes[ncbi] = cached[ncbi]
+        else:
+            stats = _summary_stats(ncbi, source)
+            genomes[ncbi] = {"key": key, "stats": stats.to_dict()}
+
+    changed = genomes.keys() != cached.keys() or any(
+        genomes[ncbi] is not cached.get(ncbi) for ncbi in genomes
+    )
+    return genomes, changed
 
-        # non-overlapping
-        txt.write(f"\t<{analysis}s>	<{analysis}-to-feature-ratio>\n")
-        if feat.intervals is not None:
 
-            # xlsx palindrome info
+def save_summaries(genomes):
+    with atomic_path(_SUMMARY_INDEX) as tmp, open(tmp, "w") as index:
+        json.dump(genomes, index)
 
-            p_all_cov_non = feat.intervals["coverage"]
 
-            ws_solo.write(rownum, 5, p_all_cov_non.count())
-            ws_solo.write(rownum, 7, p_all_cov_non.mean())
+def aggregate_palindromes(fmt="xlsx"):
+    print("*****\nAggregating all xlsx files into the overall.xlsx file.")
+    genomes, changed = load_summaries()
+    outputs = []
+    if fmt in ("xlsx", "both"):
+        outputs.append(_DIRS["results"] / "overall.xlsx")
+    if fmt in ("parquet", "both"):
+        outputs.append(_DIRS["results"] / "overall.parquet")
+    if not changed and all(path.is_file() for path in outputs):
+        print("No genome changed since the last aggregation.")
+        return
+
+    # exact statistics over the features of all genomes, independent of their order
+    overall = FeatureTypeStats(_MERGED_HEADERS[1:7], _MERGED_HEADERS[7:])
+    for genome in genomes.values():
+        overall.merge(FeatureTypeStats.from_dict(genome["stats"]))
+    rows = list(overall.rows(sorted(overall.types)))
+
+    if fmt in ("parquet", "both"):
+        with atomic_path(_DIRS["results"] / "overall.parquet") as tmp:
+            pd.DataFrame(rows, columns=_MERGED_HEADERS).to_parquet(tmp, index=False)
+    if fmt in ("xlsx", "both"):
+        _write_overall(rows)
+
+    save_summaries(genomes)
+
+
+def _write_overall(rows):
+    with atomic_path(_DIRS["results"] / "overall.xlsx") as tmp:
+        workbook = xlsxwriter.Workbook(tmp, {"nan_inf_to_errors": True})
+        ws = workbook.add_worksheet("Overall feature statistics")
+
+        bold = workbook.add_format({"bold": True})
+
+        ws.set_column(0, 6, 23)
+        ws.set_column(6, 15, 50)
+
+        ws.write_row(0, 0, _MERGED_HEADERS, bold)
+
+        # insert aggregated values
+        print("----------------------------")
+        for ir, row in enumerate(rows, start=1):
+            ws.write_row(ir, 0, row)
+
+        workbook.close()
+
+
+def _stats_sums(table):
+    """Per-feature sums of one `AnnotationTable` behind `_stats_columns`"""
+    ov = table.overlaps
+    top, bottom = np.iinfo(np.int64).max, np.iinfo(np.int64).min
+    _, count, non = _segments(ov.coverage, ov.offsets)
+    _, merged_count, merged = _segments(ov.merged_coverage, ov.merged_offsets)
+
+    return {
+        "hits": ov.hit_counts,
+        "merged hits": ov.merged_counts,
+        "count": count,
+        "non": non,
+        "merged count": merged_count,
+        "merged": merged,
+        # covered span of the hits, empty features get neutral bounds
+        "low": segment_reduce(np.minimum, ov.cov_start, ov.offsets, top),
+        "high": segment_reduce(np.maximum, ov.cov_end, ov.offsets, bottom),
+        "merged low": segment_reduce(
+            np.minimum, ov.merged_cov_start, ov.merged_offsets, top
+        ),
+        "merged high": segment_reduce(
+            np.maximum, ov.merged_cov_end, ov.merged_offsets, bottom
+        ),
+    }
 
-            for _, row in feat.intervals.iterrows():
-                txt.write(
-                    "\t%d - %d\t%.2f%%\n" % (row["start"], row["end"], row["coverage"])
-                )
 
-            txt.write(
-                f"\n  {analysis.capitalize()}s in this feature: {p_all_cov_non.count()}\n"
-            )
+def _stats_columns(features, sums):
+    """Per-feature statistics for the xlsx output of `stats`, see `_stats_sums`"""
+    hits = sums["hits"] > 0
 
-            # coverage of all R-loops in given feature (number of common R-loop nucleotides / annotation length)
-            analysis_to_feature_coverage = (
-                (feat.intervals["cov_end"].max() - feat.intervals["cov_start"].min())
-                * 100
-                / feat.len
-            )
-            txt.write(
-                f"  Total {analysis} to feature ratio in this feature: {analysis_to_feature_coverage:.2f}%\n\n"
-            )
-            ws_solo.write(rownum, 9, analysis_to_feature_coverage)
-        else:  # null values
-            ws_solo.write(rownum, 5, 0)
-            ws_solo.write(rownum, 7, 0.0)
-            ws_solo.write(rownum, 9, 0.0)
+    # coverage of all hits in given feature (number of common nucleotides / annotation length)
+    span = np.where(hits, sums["high"], 0) - np.where(hits, sums["low"], 0)
+    merged_span = np.where(hits, sums["merged high"], 0) - np.where(
+        hits, sums["merged low"], 0
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = span * 100 / (features.end - features.start)
+        merged_ratio = merged_span * 100 / (features.end - features.start)
+
+    return {
+        "hits": hits,
+        "count": sums["count"],
+        "merged": np.where(hits, _mean(sums["merged"], sums["merged count"]), 0.0),
+        "non": np.where(hits, _mean(sums["non"], sums["count"]), 0.0),
+        "merged ratio": np.where(hits, merged_ratio, 0.0),
+        "non ratio": np.where(hits, ratio, 0.0),
+    }
 
-        # merged-overlap
-        txt.write(f"\t<{analysis}s>	<{analysis}-to-feature-ratio> (merged-overlap)\n")
-        if feat.merged_intervals is not None:
 
-            p_all_cov = feat.merged_intervals["coverage"]
+class StatsSheets(_FeatureSheets):
+    """
+    Feature and merged feature sheets of a g4 or rloop analysis of one genome, filled
+    one `AnnotationTable` at a time while the detail report goes to `txt`
+    """
 
-            ws_solo.write(rownum, 6, p_all_cov.mean())
+    def __init__(
+        self, result, txt, ncbi: str, analysis: str, merged_sheet="Merged features"
+    ):
+        self.result = result
+        self.txt = txt
+        self.analysis = analysis
+        self.merged_sheet = merged_sheet
 
-            for _, row in feat.merged_intervals.iterrows():
-                txt.write(
-                    "\t%d - %d\t%.2f%%\n" % (row["start"], row["end"], row["coverage"])
-                )
+        # add headers for xlsx file
+        name = analysis.capitalize()
+        headers_solo = [
+            "Feature",
+            "Info",
+            "Feature start",
+            "Feature end",
+            "Feature size",
+            f"{name}s count",
+            f"Average coverage all {name}s - overlapping",
+            f"Average coverage all {name}s - non-overlapping",
+            f"Overall coverage of {name}s - overlapping",
+            f"Overall coverage of {name}s - non-overlapping",
+        ]
+        headers_merged = [
+            "Feature",
+            "Feature count",
+            "Total feature length",
+            f"{name}s count",
+            f"Average coverage all {name}s - overlapping",
+            f"Average coverage all {name}s - non-overlapping",
+        ]
+        result.add_sheet(
+            f"Feature to {analysis}s",
+            headers_solo,
+            (str, str, int, int, int, int) + (float,) * 4,
+            widths=[(0, 0, 10), (1, 1, 40), (2, 4, 15), (4, 8, 23), (8, 16, 50)],
+        )
+        result.add_sheet(
+            merged_sheet,
+            headers_merged,
+            (str, int, int, int, float, float),
+            widths=[(0, 6, 23), (6, 15, 50)],
+        )
 
-            txt.write(
-                f"\n  {analysis.capitalize()}s in this feature: {feat.merged_intervals['start'].count()} (merged-overlap)\n"
-            )
+        self.merged_stats = FeatureTypeStats(headers_merged[1:4], headers_merged[4:])
+
+        # General statisctics
+        txt.write(f"ANNOTATION STATISTICS: {ncbi}\n")
+        txt.write(f"==================\n\n")
+
+    def _sums(self, table):
+        return _stats_sums(table)
+
+    def _write(self, features, sums):
+        """writes the rows of the given features, returns the values of their report"""
+        arrays = _stats_columns(features, sums)
+        columns = {key: values.tolist() for key, values in arrays.items()}
+        starts = features.start.tolist()
+        ends = features.end.tolist()
+
+        # xlsx feature info, features without hits get null values
+        for row in zip(
+            features.type_names.tolist(),
+            features.info_column(),
+            starts,
+            ends,
+            (end - start for start, end in zip(starts, ends)),
+            columns["count"],
+            columns["merged"],
+            columns["non"],
+            columns["merged ratio"],
+            columns["non ratio"],
+        ):
+            self.result.write_row(f"Feature to {self.analysis}s", row)
+
+        # only features with hits are merged
+        hits = arrays["hits"]
+        self.merged_stats.update(
+            features.type_names[hits],
+            np.column_stack(
+                [
+                    np.ones(len(features), dtype=np.int64),
+                    features.end - features.start,
+                    arrays["count"],
+                ]
+            )[hits],
+            np.column_stack([arrays["merged"], arrays["non"]])[hits],
+        )
 
-            # coverage of all R-loops in given feature (number of common R-loop nucleotides / annotation length)
-            analysis_to_feature_coverage_merged = (
-                (
-                    feat.merged_intervals["cov_end"].max()
-                    - feat.merged_intervals["cov_start"].min()
-                )
-                * 100
-                / feat.len
-            )
-            txt.write(
-                f"  Total {analysis} to feature ratio in this feature: {analysis_to_feature_coverage_merged:.2f}% (merged-overlap)\n\n"
+        return columns["count"], columns["non ratio"], columns["merged ratio"]
+
+
+def stats(tables, ncbi, analysis: str, fmt="xlsx"):
+
+    with atomic_path(_DIRS["results"] / f"{ncbi}.txt") as txt_path, ResultWriter(
+        ncbi, fmt
+    ) as result, open(txt_path, "w") as txt:
+        sheets = StatsSheets(result, txt, ncbi, analysis)
+        for table in tables:
+            sheets.add(table)
+        sheets.close()
+
+
+def combined_stats(batches, ncbi, analyses, fmt="xlsx"):
+    """Writes the results of several analyses of one genome in a single pass.
+
+    The workbook gets the feature sheet and a `Merged {analysis} features` sheet of every
+    analysis, the text report one section per analysis. Sections are buffered in
+    temporary files while the batches come, so they do not interleave.
+
+    Args:
+        batches (iterable): dicts of the `AnnotationTable` of every analysis for one
+            batch of annotations, see `feature.process_analyses`
+        ncbi (str): NCBI ID of the processed sequence
+        analyses (tuple): analysis types, in the order of the sheets
+        fmt (str): output format, `xlsx`, `parquet` or `both`
+    """
+    with atomic_path(_DIRS["results"] / f"{ncbi}.txt") as txt_path, ResultWriter(
+        ncbi, fmt
+    ) as result, ExitStack() as reports:
+        sheets = {}
+        for analysis in analyses:
+            report = reports.enter_context(tempfile.TemporaryFile("w+"))
+            merged_sheet = f"Merged {analysis} features"
+            sheets[analysis] = (
+                PalindromeSheets(result, report, ncbi, merged_sheet)
+                if analysis == "palindrome"
+                else StatsSheets(result, report, ncbi, analysis, merged_sheet)
             )
-            ws_solo.write(rownum, 8, analysis_to_feature_coverage_merged)
-
-            if feat.type in merged_feature_data:
-                # skip 1st - feature name
-                merged_feature_data[feat.type][1] += 1  # cnt
-                merged_feature_data[feat.type][2] += feat.end - feat.start  # len
-                merged_feature_data[feat.type][
-                    3
-                ] += p_all_cov_non.count()  # all palindromes
-
-                merged_feature_data[feat.type][4] = (
-                    merged_feature_data[feat.type][4] + p_all_cov_non.mean()
-                    if not p_all_cov_non.empty
-                    else 0.0
-                ) / 2
-                merged_feature_data[feat.type][5] = (
-                    merged_feature_data[feat.type][5] + p_all_cov.mean()
-                    if not p_all_cov.empty
-                    else 0.0
-                ) / 2
-            else:
-                merged_feature_data[feat.type] = [
-                    feat.type,
-                    1,
-                    (feat.end - feat.start),
-                    p_all_cov_non.count(),
-                    p_all_cov_non.mean() if not p_all_cov_non.empty else 0.0,
-                    p_all_cov.mean() if not p_all_cov.empty else 0.0,
-                ]
-        else:  # null values
-            ws_solo.write(rownum, 6, 0.0)
-            ws_solo.write(rownum, 8, 0.0)
-
-    xlsx_row_cnt = 1
-    for row in merged_feature_data.values():
-        for ix, col in enumerate(row):
-            ws_merged.write(xlsx_row_cnt, ix, col)
-        xlsx_row_cnt += 1
-
-    txt.close()
-    workbook.close()
+
+        for tables in batches:
+            for analysis, table in tables.items():
+                sheets[analysis].add(table)
+
+        with open(txt_path, "w") as txt:
+            for analysis in analyses:
+                sheets[analysis].close()
+                sheets[analysis].txt.seek(0)
+                shutil.copyfileobj(sheets[analysis].txt, txt)
+
+    if "palindrome" in sheets:
+        _write_summary(ncbi, sheets["palindrome"].merged_stats)
@@ -0,0 +1,207 @@
+import numpy as np
+
+
+class MiddleIndex:
+    """
+    Hits sorted by their middle once, so any number of interval batches can be
+    paired with them by binary search.
+    """
+
+    def __init__(self, middles):
+        self.order = np.argsort(middles, kind="stable")
+        self.sorted_middles = middles[self.order]
+
+    def pair(self, starts, ends):
+        """Pairs every interval with all hits whose middle lies inside [start, end].
+
+        The cost scales with the number of pairs found, not with intervals x hits.
+
+        Args:
+            starts (np.ndarray): interval starts
+            ends (np.ndarray): interval ends
+
+        Returns:
+            tuple: interval indices and hit indices of the pairs, grouped by interval,
+                hits of one interval are kept in file order
+        """
+        lo = np.searchsorted(self.sorted_middles, starts, side="left")
+        hi = np.searchsorted(self.sorted_middles, ends, side="right")
+        counts = np.maximum(hi - lo, 0)
+
+        interval_ix = np.repeat(np.arange(len(starts)), counts)
+        # position of every pair inside the slice of its interval
+        first = np.cumsum(counts) - counts
+        within = np.arange(counts.sum()) - np.repeat(first, counts)
+        hit_ix = self.order[np.repeat(lo, counts) + within]
+
+        # the slices are in middle order, put the hits of every interval back to file order
+        reorder = np.lexsort((hit_ix, interval_ix))
+        return interval_ix[reorder], hit_ix[reorder]
+
+
+def pair_by_middle(starts, ends, middles):
+    """Pairs every interval with all hits whose middle lies inside [start, end], see `MiddleIndex.pair`"""
+    return MiddleIndex(middles).pair(starts, ends)
+
+
+def offsets_from_index(index, size):
+    """Converts sorted group indices into `size + 1` offsets, group i is [off[i], off[i + 1])"""
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(index, minlength=size), out=offsets[1:])
+    return offsets
+
+
+def segment_reduce(ufunc, values, offsets, empty=0):
+    """Reduces `values` over every [off[i], off[i + 1]) segment, empty segments get `empty`"""
+    starts = offsets[:-1]
+    nonempty = offsets[1:] > starts
+    result = np.full(len(starts), empty, dtype=np.result_type(values, type(empty)))
+    if nonempty.any():
+        result[nonempty] = ufunc.reduceat(values, starts[nonempty])
+    return result
+
+
+# per-hit and per-merged-hit arrays of `Overlaps`
+_HIT_ARRAYS = ("start", "end", "len", "cov_start", "cov_end", "coverage")
+_MERGED_ARRAYS = (
+    "merged_start",
+    "merged_end",
+    "merged_cov_start",
+    "merged_cov_end",
+    "merged_len",
+    "merged_coverage",
+)
+
+
+class Overlaps:
+    """
+    Overlap of all annotations with all analysis hits, stored as flat arrays.
+
+    Hits of annotation i are rows [offsets[i], offsets[i + 1]) of the `hit_*` arrays,
+    its merged overlapping hits are rows [merged_offsets[i], merged_offsets[i + 1])
+    of the `merged_*` arrays.
+    """
+
+    def __init__(self, ann_start, ann_end, hit_start, hit_end, hit_len, index):
+        ann_start = np.asarray(ann_start, dtype=np.int64)
+        ann_end = np.asarray(ann_end, dtype=np.int64)
+        size = len(ann_start)
+
+        # if the middle of the hit is still inside annotation, we include that hit
+        ann, hit = index.pair(ann_start, ann_end)
+        self.offsets = offsets_from_index(ann, size)
+
+        self.start = start = hit_start[hit].astype(np.int64)
+        self.end = end = hit_end[hit].astype(np.int64)
+        self.len = hit_len[hit]
+        diff = (ann_end - ann_start)[ann]
+
+        # normalise start/end positions for overlap, but keep original start/end values for output
+        # when we have shorter annotation than last hit, we need to count the overlap only for
+        # the length of the annotation
+        self.cov_start = np.maximum(start, ann_start[ann])
+        self.cov_end = np.minimum(end, ann_end[ann])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.coverage = (self.cov_end - self.cov_start) / diff * 100.0
+
+        # a new overlap group starts with every annotation and with every hit
+        # starting after the end of the previous one
+        new_group = np.ones(len(start), dtype=bool)
+        new_group[1:] = start[1:] > end[:-1]
+        new_group[self.offsets[:-1][np.diff(self.offsets) > 0]] = True
+        group_first = np.flatnonzero(new_group)
+
+        merged_ann = ann[group_first]
+        self.merged_offsets = offsets_from_index(merged_ann, size)
+        self.merged_start = (
+            np.minimum.reduceat(start, group_first) if len(start) else start
+        )
+        self.merged_end = np.maximum.reduceat(end, group_first) if len(end) else end
+
+        # calculate cov for overlapping hits, same normalisation process
+        self.merged_cov_start = np.maximum(self.merged_start, ann_start[merged_ann])
+        self.merged_cov_end = np.minimum(self.merged_end, ann_end[merged_ann])
+        self.merged_len = self.merged_cov_end - self.merged_cov_start
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.merged_coverage = (
+                self.merged_len / (ann_end - ann_start)[merged_ann] * 100.0
+            )
+
+    @classmethod
+    def join(cls, parts, order):
+        """Joins the overlaps of consecutive groups of annotations into one.
+
+        Args:
+            parts (list): `Overlaps` of consecutive groups of annotations
+            order (np.ndarray): index into the joined annotations of every annotation
+                of the result, e.g. to put annotations processed sorted back in place
+
+        Returns:
+            Overlaps: overlaps of the annotations in the given order
+        """
+        joined = cls.__new__(cls)
+        for offsets, names in (
+            ("offsets", _HIT_ARRAYS),
+            ("merged_offsets", _MERGED_ARRAYS),
+        ):
+            # first row and row count of every annotation in the concatenated arrays
+            firsts, counts, rows = [], [], 0
+            for part in parts:
+                part_offsets = getattr(part, offsets)
+                firsts.append(part_offsets[:-1] + rows)
+                counts.append(np.diff(part_offsets))
+                rows += part_offsets[-1]
+            first = np.concatenate(firsts)[order]
+            count = np.concatenate(counts)[order]
+
+            new_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+            np.cumsum(count, out=new_offsets[1:])
+            take = np.repeat(first - new_offsets[:-1], count) + np.arange(
+                new_offsets[-1]
+            )
+
+            setattr(joined, offsets, new_offsets)
+            for name in names:
+                setattr(
+                    joined,
+                    name,
+                    np.concatenate([getattr(part, name) for part in parts])[take],
+                )
+        return joined
+
+    @property
+    def hit_counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def merged_counts(self):
+        return np.diff(self.merged_offsets)
+
+
+def bin_intervals(starts, ends, length, bins=100):
+    """Counts intervals lying completely inside each of `bins` equal parts of a sequence.
+
+    Bin i spans [int(i * length / bins), int(start_i + 1 + length / bins)], neighbouring bins
+    share their borders, so an interval on a border is counted in both of them.
+
+    Args:
+        starts (np.ndarray): interval starts
+        ends (np.ndarray): interval ends
+        length (int): sequence length
+        bins (int): number of bins
+
+    Returns:
+        tuple: bin starts, bin ends and the interval count of every bin
+    """
+    step = length / bins
+    bin_starts = (np.arange(bins) * step).astype(np.int64)
+    bin_ends = (bin_starts + 1 + step).astype(np.int64)
+
+    # both bin borders grow with i, so the bins holding an interval form a range
+    first = np.searchsorted(bin_ends, ends, side="left")
+    last = np.searchsorted(bin_starts, starts, side="right")
+    inside = first < last
+
+    diff = np.bincount(first[inside], minlength=bins + 1)
+    diff -= np.bincount(last[inside], minlength=bins + 1)
+    return bin_starts, bin_ends, np.cumsum(diff)[:bins]
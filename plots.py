@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+
+from utils import _DIRS, atomic_path
+
+# dpi of the rendered figures per plot mode, `none` renders nothing
+_PLOT_DPI = {"fast": 100, "publication": 600}
+
+
+def _pyplot():
+    # matplotlib is only loaded when something is rendered, never for a display
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def plot_overlap(df_agg, first: str, second: str, ncbi: str, plots="publication"):
+    """Bar chart of max coverage and count of the overlaps between two analyses"""
+    if plots == "none":
+        return
+    plt = _pyplot()
+
+    df_best_regions = df_agg.loc[df_agg["Overlap_count"] >= 0]
+    x = df_best_regions["Middle_x"]
+    width = 10000  # the width of the bars
+
+    fig, ax = plt.subplots()
+    rects1 = ax.bar(
+        x - width / 2,
+        round(df_best_regions["Overlap_max"] * 100),
+        width,
+        label="Overlap max coverage [%]",
+    )
+    rects2 = ax.bar(
+        x + width / 2,
+        df_best_regions["Overlap_count"],
+        width,
+        label="Overlap region count [N]",
+    )
+    ax.set_ylabel("Overlap")
+    ax.set_xlabel("Sequence length [N]")
+    ax.set_title(
+        f"{first.capitalize()} to {second.capitalize()} max coverage to occurence ratio [{ncbi}]"
+    )
+    ax.legend()
+    ax.set_xlim(x.min() - width, x.max() + width)
+    plt.xticks(np.arange(0, x.max() + width, 100000))
+
+    figure = plt.gcf()
+    figure.set_size_inches(19.2, 10.8)
+    with atomic_path(_DIRS["results"] / f"{ncbi}_analysis.png") as tmp:
+        plt.savefig(tmp, dpi=_PLOT_DPI[plots], format="png", bbox_inches="tight")
+    plt.close(figure)
+
+
+def plot_heatmaps(df_heatmap, first: str, second: str, ncbi: str, plots="publication"):
+    """Heatmaps of the binned overlap counts, see `overlap.bin_intervals`.
+
+    The `fast` mode writes the counts straight into a raster image, one band per heatmap
+    scaled to its own maximum, `publication` renders the full figure with colorbars.
+    """
+    if plots == "none":
+        return
+
+    y1 = df_heatmap.iloc[:, 2].to_numpy()
+    y2 = df_heatmap.iloc[:, 3].to_numpy()
+
+    if plots == "fast":
+        from matplotlib.image import imsave
+
+        bands = np.vstack(
+            [
+                np.repeat(y[np.newaxis, :] / max(y.max(), 1), 20, axis=0)
+                for y in (y1, y2)
+            ]
+        )
+        with atomic_path(_DIRS["results"] / f"{ncbi}_count.png") as tmp:
+            imsave(tmp, bands, cmap="plasma", vmin=0, vmax=1, format="png")
+        return
+
+    plt = _pyplot()
+    x = np.arange(len(df_heatmap))
+
+    plt.rcParams["figure.figsize"] = 5, 2
+    fig, (ax, ax1) = plt.subplots(nrows=2, sharex=True)
+
+    extent = [x[0] - 0.5, x[-1] + 0.5, 0, 1]
+
+    pos_ax = ax.imshow(y1[np.newaxis, :], cmap="plasma", aspect="auto", extent=extent)
+    fig.colorbar(pos_ax, ax=ax)
+
+    pos_ax1 = ax1.imshow(y2[np.newaxis, :], cmap="plasma", aspect="auto", extent=extent)
+    fig.colorbar(pos_ax1, ax=ax1)
+
+    ax.set_yticks([])
+    ax.set_xlim(extent[0], extent[1])
+    ax1.set_yticks([])
+    ax1.set_xlim(extent[0], extent[1])
+
+    ax.set_title(
+        f"Overlap count for {second.capitalize()}s and {first.capitalize()}s [{ncbi}]"
+    )
+    ax1.set_title(f"Overlap count for {first.capitalize()}s and annotations [{ncbi}]")
+
+    ax.set_xlabel("Sequence length [N]")
+    ax.set_ylabel("Overlap count [N]")
+    ax1.set_xlabel("Sequence length [N]")
+    ax1.set_ylabel("Overlap count [N]")
+
+    plt.tight_layout()
+    figure = plt.gcf()
+    figure.set_size_inches(8, 6)
+    with atomic_path(_DIRS["results"] / f"{ncbi}_count.png") as tmp:
+        plt.savefig(tmp, dpi=_PLOT_DPI[plots], format="png", bbox_inches="tight")
+    plt.close(figure)
+
+
+def render_comparison(first: str, second: str, ncbi: str, plots="publication"):
+    """Renders the plots of an earlier comparison of two analyses from its cached results.
+
+    Args:
+        first (str): first analysis type
+        second (str): second analysis type
+        ncbi (str): NCBI ID of the compared sequence
+        plots (str): plot mode, `fast` or `publication`
+
+    Returns:
+        bool: False if the results of this pair of analyses are missing
+    """
+    agg_path = _DIRS["results"] / f"{ncbi}_{first}_{second}_agg.csv"
+    heatmap_path = _DIRS["results"] / f"{ncbi}_{first}_{second}_heatmap.csv"
+    if not agg_path.is_file() or not heatmap_path.is_file():
+        print(f"No cached comparison {first} x {second} for {ncbi}, run it first.")
+        return False
+
+    print(f"Rendering comparison {first} x {second} for {ncbi}")
+    plot_overlap(pd.read_csv(agg_path, index_col=0), first, second, ncbi, plots)
+    plot_heatmaps(pd.read_csv(heatmap_path), first, second, ncbi, plots)
+    return True
@@ -1,145 +1,482 @@
 import json
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 import requests
-from tenacity import retry, stop_after_attempt
+import tenacity
+from requests.adapters import HTTPAdapter
 
 from lambdas import ncbi_to_feature, ncbi_to_sequence
-from utils import _DIRS
+from sequence_index import index_sequence
+from utils import _ANALYSIS_COLUMNS, _DIRS, atomic_path
 
+NCBI_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+# NCBI IDs requested by one efetch call
+BATCH_SIZE = 100
+# (connect, read) timeout in seconds of every request
+TIMEOUT = (10, 120)
+# open connections kept per host, also the default number of concurrent downloads
+CONNECTIONS = 8
 
-class Remote:
-    """
-    class for API connections and file downloads
+ANALYSER_BASE_URL = "https://bioinformatics.ibp.cz/"
+# result file of every analysis the DNA Analyser runs without manual steps
+_RESULT_FILES = {"rloop": "rloopr.csv"}
+AUTOMATED_ANALYSES = tuple(_RESULT_FILES)
+# batch states of analyses that ended without a result, any state but these and
+# FINISH counts as still running and is polled again until the deadline
+_FAILED_STATUSES = ("FAILED", "FAILURE", "ERROR", "CANCELED", "CANCELLED", "ABORTED")
+# seconds to wait for submitted analyses and the longest pause between two polls
+ANALYSIS_DEADLINE = 300
+MAX_POLL_INTERVAL = 30
+
+# only failed requests are repeated, malformed responses fail at once
+_retry_requests = tenacity.retry(
+    retry=tenacity.retry_if_exception_type(requests.RequestException),
+    stop=tenacity.stop_after_attempt(3),
+    wait=tenacity.wait_exponential(max=10),
+    reraise=True,
+)
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def make_session(connections: int = CONNECTIONS):
+    """`requests.Session` keeping up to `connections` connections per host alive"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def shared_session():
+    """session reused by every `Remote` created without its own"""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = make_session()
+        return _shared_session
+
+
+def _fasta_id(header: bytes):
+    # >NC_004337.2 Shigella flexneri 2a str. 301 chromosome, complete genome
+    return header[1:].split(maxsplit=1)[0].decode()
+
+
+def _feature_id(header: bytes):
+    # >Feature ref|NC_004337.2|
+    ref = header[1:].split(maxsplit=1)[-1].strip()
+    return (ref.split(b"|")[1] if b"|" in ref else ref).decode()
+
+
+# file, header parser and header prefix of the records of every efetch `rettype`
+_RECORDS = {
+    "fasta": (ncbi_to_sequence, _fasta_id, b">"),
+    "ft": (ncbi_to_feature, _feature_id, b">Feature"),
+}
+
+
+def _check_record(rettype: str, ncbi, size: int):
+    # a feature table may be empty, a sequence may not
+    if ncbi is not None and rettype == "fasta" and not size:
+        raise ValueError(f"efetch returned an empty sequence for {ncbi}")
+
+
+def check_analysis_file(path, analysis: str):
+    """raises ValueError unless the file starts with the header of a DNA Analyser export"""
+    with open(path, "rb") as csv:
+        header = csv.readline().decode(errors="replace").rstrip("\r\n")
+    columns = {column.strip('"') for column in header.split("\t")}
+    missing = [
+        column for column in _ANALYSIS_COLUMNS[analysis] if column not in columns
+    ]
+    if missing:
+        raise ValueError(f"{analysis} file misses columns {', '.join(missing)}")
+
+
+@_retry_requests
+def fetch_records(ncbis, rettype: str, session=None, base_url: str = NCBI_BASE_URL):
+    """Downloads the records of many NCBI IDs with a single efetch request.
+
+    The concatenated response is streamed line by line into the file of every record,
+    `sequences/{id}.fasta` or `features/{id}.txt`, which is moved into place once the
+    next record starts, so neither the response nor a partial file is ever kept.
+    Every record must start with the header of its type, sequences must not be empty
+    and each NCBI ID may get only one record, otherwise ValueError is raised.
+
+    Args:
+        ncbis (list): NCBI IDs of one batch
+        rettype (str): `fasta` for sequences or `ft` for feature tables
+        session (requests.Session): session of the request, the shared one by default
+        base_url (str): root of the E-utilities, e.g. of a local stub server
+
+    Returns:
+        list: requested NCBI IDs that got a record, in the order of the response
     """
+    session = shared_session() if session is None else session
+    path, record_id, header = _RECORDS[rettype]
+    pending = list(ncbis)
+    written = []
 
-    def __init__(self, ncbi: str):
-        self.ncbi = ncbi
-        self.ncbi_base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
-        self.analyser_base_url = "https://bioinformatics.ibp.cz/"
+    with session.get(
+        f"{base_url}efetch.fcgi?db=nuccore&id={','.join(ncbis)}&rettype={rettype}&retmode=text",
+        stream=True,
+        timeout=TIMEOUT,
+    ) as response, ExitStack() as record:
+        response.raise_for_status()
+        out = ncbi = None
+        size = 0
+        for line in response.iter_lines(chunk_size=1 << 16):
+            if line.startswith(b">"):
+                # finish the previous record
+                _check_record(rettype, ncbi, size)
+                record.close()
+                if not line.startswith(header):
+                    raise ValueError(f"efetch returned malformed header {line[:80]!r}")
+                found = record_id(line)
+                # IDs requested without a version are returned with one
+                ncbi = next(
+                    (x for x in pending if found == x or found.startswith(f"{x}.")),
+                    None,
+                )
+                if ncbi is None:
+                    raise ValueError(f"efetch returned unrequested record {found}")
+                pending.remove(ncbi)
+                written.append(ncbi)
+                out = record.enter_context(
+                    open(record.enter_context(atomic_path(path(ncbi))), "wb")
+                )
+                size = 0
+            elif out is not None:
+                size += len(line.strip())
+            if out is not None:
+                out.write(line + b"\n")
+        _check_record(rettype, ncbi, size)
 
-    def get_sequence(self):
-        r = requests.get(
-            f"{self.ncbi_base_url}efetch.fcgi?db=nuccore&id={self.ncbi}&rettype=fasta&retmode=text"
-        )
+    if rettype == "fasta":
+        for ncbi in written:
+            index_sequence(ncbi)
+    return written
 
-        with open(ncbi_to_sequence(self.ncbi), "w") as out:
-            out.write(r.text)
 
-    @retry(stop=stop_after_attempt(3))
-    def get_annotation_file(self):
+@_retry_requests
+def _get(session, url: str, **kwargs):
+    """GET with a timeout, failed requests and error responses are retried"""
+    response = session.get(url, timeout=TIMEOUT, **kwargs)
+    response.raise_for_status()
+    return response
 
-        if not ncbi_to_sequence(self.ncbi).is_file():
-            self.get_sequence()
 
-        r = requests.get(
-            f"{self.ncbi_base_url}efetch.fcgi?db=nuccore&id={self.ncbi}&rettype=ft&retmode=text"
-        )
-        with open(ncbi_to_feature(self.ncbi), "w") as out:
-            out.write(r.text)
-        return True
+def _post(session, url: str, **kwargs):
+    # not retried on its own, a repeated POST would submit the same job twice
+    response = session.post(url, timeout=TIMEOUT, **kwargs)
+    response.raise_for_status()
+    return response
 
-    @retry(stop=stop_after_attempt(3))
-    def get_analysis(self, type: str):
 
-        if not ncbi_to_sequence(self.ncbi).is_file():
-            self.get_sequence()
+def _analysis_request(type: str, seq_id: str):
+    """endpoint and payload starting the given analysis of an imported sequence"""
+    return {
+        "rloop": {
+            "url": "api/analyse/rloopr",
+            "data": json.dumps(
+                {"rizModel": [0], "sequence": seq_id, "tags": ["overlapper"]}
+            ),
+        },
+        "g4": {
+            "url": "api/analyse/g4hunter",
+            "data": json.dumps(
+                {
+                    "sequence": seq_id,
+                    "tags": ["overlapper"],
+                    "threshold": 1.1,
+                    "windowSize": 25,
+                }
+            ),
+        },
+        "palindrome": {
+            "url": "api/analyse/palindrome",
+            "data": json.dumps(
+                {
+                    "dinucleotide": True,
+                    "mismatches": "0,1",
+                    "sequences": [seq_id],
+                    "size": "6-30",
+                    "spacer": "0-10",
+                    "stabilityModel": "NN_MODEL_STABILITY",
+                    "tags": ["overlapper"],
+                }
+            ),
+        },
+    }[type]
+
+
+class AnalyserJobs:
+    """
+    Runs one analysis type for many sequences on the DNA Analyser at once.
+
+    The sequences are imported with one request and all analyses are started
+    right away. Pending batches are then polled together, with a pause that
+    doubles up to `MAX_POLL_INTERVAL` until they finish or the deadline passes, and every
+    result is downloaded as soon as it is ready. One JWT serves all requests.
+    """
 
-        host_token = requests.post(f"{self.analyser_base_url}api/jwt").text
-        headers = {"Authorization": host_token, "Content-Type": "application/json"}
+    def __init__(
+        self,
+        analysis: str,
+        session=None,
+        base_url: str = ANALYSER_BASE_URL,
+        connections: int = CONNECTIONS,
+    ):
+        self.analysis = analysis
+        self.session = shared_session() if session is None else session
+        self.base_url = base_url
+        self.connections = connections
+        # NCBI ID -> batch ID of the analyses still running
+        self.batches = {}
+        self._token = None
 
+    @property
+    def headers(self):
+        if self._token is None:
+            self._token = _post(self.session, f"{self.base_url}api/jwt").text
+        return {"Authorization": self._token, "Content-Type": "application/json"}
+
+    def submit(self, ncbis):
+        """imports the sequences of the given NCBI IDs and starts their analyses"""
+        # results depend on the topology, sequences are always submitted as circular,
+        # the heuristic `circular` flag of the sequence index is metadata only
         data = json.dumps(
             {
                 "circular": True,
                 "ncbis": [
                     {
                         "circular": True,
-                        "name": self.ncbi,
-                        "ncbiId": self.ncbi,
+                        "name": ncbi,
+                        "ncbiId": ncbi,
                         "tags": ["overlapper"],
                         "type": "DNA",
                     }
+                    for ncbi in ncbis
                 ],
                 "tags": ["overlapper"],
                 "type": "DNA",
             }
         )
-
-        # upload sequence
-        r_seq = requests.post(
-            f"{self.analyser_base_url}/api/sequence/import/ncbi",
+        r_seq = _post(
+            self.session,
+            f"{self.base_url}/api/sequence/import/ncbi",
             data=data,
-            headers=headers,
+            headers=self.headers,
         )
-        seq_id = str(r_seq.json()["items"][0]["id"])
-
-        analyse_map = {
-            "rloop": {
-                "url": "api/analyse/rloopr",
-                "data": json.dumps(
-                    {"rizModel": [0], "sequence": seq_id, "tags": ["overlapper"]}
-                ),
-            },
-            "g4": {
-                "url": "api/analyse/g4hunter",
-                "data": json.dumps(
-                    {
-                        "sequence": seq_id,
-                        "tags": ["overlapper"],
-                        "threshold": 1.1,
-                        "windowSize": 25,
-                    }
-                ),
-            },
-            "palindrome": {
-                "url": "api/analyse/palindrome",
-                "data": json.dumps(
-                    {
-                        "dinucleotide": True,
-                        "mismatches": "0,1",
-                        "sequences": [seq_id],
-                        "size": "6-30",
-                        "spacer": "0-10",
-                        "stabilityModel": "NN_MODEL_STABILITY",
-                        "tags": ["overlapper"],
-                    }
-                ),
-            },
-        }
+        imported = {}
+        for item in r_seq.json()["items"]:
+            name = item.get("ncbiId") or item.get("name") or ""
+            # IDs requested without a version may be returned with one
+            ncbi = next(
+                (x for x in ncbis if name == x or name.startswith(f"{x}.")), None
+            )
+            if ncbi is not None:
+                imported.setdefault(ncbi, str(item["id"]))
+        missing = [ncbi for ncbi in ncbis if ncbi not in imported]
+        if missing:
+            print(f"DNA Analyser did not import {', '.join(missing)}")
+
+        for ncbi, seq_id in imported.items():
+            request = _analysis_request(self.analysis, seq_id)
+            ra = _post(
+                self.session,
+                f'{self.base_url}/{request["url"]}',
+                data=request["data"],
+                headers=self.headers,
+            )
+            self.batches[ncbi] = str(ra.json()["payload"]["id"])
+
+    def _download(self, ncbi: str):
+        """
+        downloads the result of a finished batch, a batch in one of `_FAILED_STATUSES`
+        raises ValueError, in any other state it is still running and False is returned
+        """
+        url = f'{self.base_url}/{_analysis_request(self.analysis, "")["url"]}/{self.batches[ncbi]}'
+        result = _get(self.session, f"{url}/analysis", headers=self.headers)
+        status = result.json()["batch"]["status"]
+        if status in _FAILED_STATUSES:
+            raise ValueError(f"analysis batch ended with status {status}")
+        if status != "FINISH":
+            return False
+
+        with _get(
+            self.session,
+            f"{url}/{_RESULT_FILES[self.analysis]}",
+            headers=self.headers,
+            stream=True,
+        ) as file_request, atomic_path(
+            _DIRS[self.analysis] / f"{ncbi}_{self.analysis}.csv"
+        ) as tmp:
+            with open(tmp, "wb") as out:
+                for chunk in file_request.iter_content(chunk_size=1 << 16):
+                    out.write(chunk)
+            check_analysis_file(tmp, self.analysis)
+        return True
+
+    def wait(self, deadline: float = ANALYSIS_DEADLINE):
+        """Polls all submitted analyses until they are downloaded or `deadline` seconds pass.
+
+        Returns:
+            list: NCBI IDs whose results were downloaded
+        """
+        done = []
+        stop = time.monotonic() + deadline
+        pause = 1
+        with ThreadPoolExecutor(max_workers=self.connections) as pool:
+            while True:
+                futures = {
+                    ncbi: pool.submit(self._download, ncbi) for ncbi in self.batches
+                }
+                for ncbi, future in futures.items():
+                    try:
+                        finished = future.result()
+                    except Exception as exc:
+                        print(f"Unable to download {self.analysis} of {ncbi}: {exc}")
+                        finished = None
+                    if finished is not False:
+                        del self.batches[ncbi]
+                    if finished:
+                        done.append(ncbi)
+
+                if not self.batches:
+                    return done
+                remaining = stop - time.monotonic()
+                if remaining <= 0:
+                    print(
+                        f"Waiting for {self.analysis} of {', '.join(self.batches)} was over {deadline} seconds, please try again later"
+                    )
+                    return done
+                print(f"Waiting for {len(self.batches)} analyses to finish...")
+                time.sleep(min(pause, remaining))
+                pause = min(2 * pause, MAX_POLL_INTERVAL)
+
+
+class Remote:
+    """
+    class for API connections and file downloads
+    """
+
+    def __init__(self, ncbi: str, session=None, ncbi_base_url: str = NCBI_BASE_URL):
+        self.ncbi = ncbi
+        self.ncbi_base_url = ncbi_base_url
+        self.analyser_base_url = ANALYSER_BASE_URL
+        self.session = shared_session() if session is None else session
+
+    def get_sequence(self):
+        if not fetch_records([self.ncbi], "fasta", self.session, self.ncbi_base_url):
+            raise ValueError(f"NCBI returned no sequence for {self.ncbi}")
+
+    def get_annotation_file(self):
+
+        if not ncbi_to_sequence(self.ncbi).is_file():
+            self.get_sequence()
+
+        return bool(fetch_records([self.ncbi], "ft", self.session, self.ncbi_base_url))
+
+    def get_analysis(self, type: str):
 
-        if type != "rloop":
-            print(
+        if type not in AUTOMATED_ANALYSES:
+            # reported by the caller for this genome only, the others go on
+            raise ValueError(
                 f"Sorry, the DNA Analyser website supports only automated R-loop processing.\n For the {type} analysis, you have to process and download the files yourself at: {self.analyser_base_url}"
             )
-            exit(0)
 
-        ra = requests.post(
-            f'{self.analyser_base_url}/{analyse_map[type]["url"]}',
-            data=analyse_map[type]["data"],
-            headers=headers,
-        )
-        batch_id = str(ra.json()["payload"]["id"])
+        if not ncbi_to_sequence(self.ncbi).is_file():
+            self.get_sequence()
+
+        jobs = AnalyserJobs(type, self.session, self.analyser_base_url)
+        jobs.submit([self.ncbi])
+        return bool(jobs.wait())
+
 
-        tick = 0
-        while True:
-            result = requests.get(
-                f'{self.analyser_base_url}/{analyse_map[type]["url"]}/{batch_id}/analysis',
-                headers=headers,
+def prefetch(
+    ncbis,
+    connections: int = CONNECTIONS,
+    batch_size: int = BATCH_SIZE,
+    base_url: str = NCBI_BASE_URL,
+):
+    """Downloads the missing sequences and feature tables of many NCBI IDs.
+
+    The IDs are requested `batch_size` at a time, see `fetch_records`, and the batches
+    run concurrently over one pooled session, so the round trips overlap instead of
+    adding up and no connection is opened twice.
+
+    Args:
+        ncbis (list): NCBI IDs to download
+        connections (int): maximal number of concurrent requests
+        batch_size (int): NCBI IDs per request
+        base_url (str): root of the E-utilities
+
+    Returns:
+        list: NCBI IDs whose files could not be downloaded
+    """
+    ncbis = list(dict.fromkeys(ncbis))
+    batches = []
+    for rettype, path in (("fasta", ncbi_to_sequence), ("ft", ncbi_to_feature)):
+        missing = [ncbi for ncbi in ncbis if not path(ncbi).is_file()]
+        batches += [
+            (rettype, missing[ix : ix + batch_size])
+            for ix in range(0, len(missing), batch_size)
+        ]
+    if not batches:
+        return []
+
+    print(
+        f"Downloading missing files of {len(ncbis)} genomes in {len(batches)} requests, {connections} at a time..."
+    )
+    failed = []
+    with make_session(connections) as session, ThreadPoolExecutor(
+        max_workers=connections
+    ) as pool:
+        futures = [
+            (
+                rettype,
+                batch,
+                pool.submit(fetch_records, batch, rettype, session, base_url),
             )
-            if result.json()["batch"]["status"] == "FINISH":
-                file_request = requests.get(
-                    f'{self.analyser_base_url}/{analyse_map[type]["url"]}/{batch_id}/rloopr.csv',
-                    headers=headers,
-                )
-                with open(_DIRS["rloop"] / f"{self.ncbi}_rloop.csv", "w") as out:
-                    out.write(file_request.text)
-                    return True
-            elif tick == 300:
-                # 5 minutes passed, let's go
-                print(
-                    "Waiting for analysis to complete was over 5 minutes, please try again later"
-                )
-            else:
-                tick += 1
-                print("Waiting for an analysis to finish...")
-                time.sleep(1)
+            for rettype, batch in batches
+        ]
+        for rettype, batch, future in futures:
+            try:
+                written = future.result()
+            except Exception as exc:
+                print(f"Unable to download {', '.join(batch)}: {exc}")
+                failed += batch
+                continue
+            missing = [ncbi for ncbi in batch if ncbi not in written]
+            if missing:
+                print(f"NCBI returned no {rettype} records for {', '.join(missing)}")
+            failed += missing
+    return list(dict.fromkeys(failed))
+
+
+def fetch_analyses(
+    analysis: str,
+    ncbis,
+    connections: int = CONNECTIONS,
+    base_url: str = ANALYSER_BASE_URL,
+    deadline: float = ANALYSIS_DEADLINE,
+):
+    """Runs the given analysis of many sequences as concurrent DNA Analyser jobs.
+
+    Returns:
+        list: NCBI IDs whose analysis files could not be downloaded
+    """
+    print(f"Running {analysis} analysis of {len(ncbis)} sequences...")
+    with make_session(connections) as session:
+        jobs = AnalyserJobs(analysis, session, base_url, connections)
+        try:
+            jobs.submit(ncbis)
+        except Exception as exc:
+            print(f"Unable to submit {analysis} analyses: {exc}")
+        done = jobs.wait(deadline)
+    return [ncbi for ncbi in ncbis if ncbi not in done]
@@ -0,0 +1,118 @@
+import hashlib
+import json
+from functools import lru_cache
+from pathlib import Path
+
+from lambdas import ncbi_to_feature
+from out import result_exists
+from utils import _DIRS, atomic_path
+
+# modules whose code decides the content of the results
+_RESULT_MODULES = (
+    "accumulator.py",
+    "analysis_io.py",
+    "feature.py",
+    "ftable.py",
+    "out.py",
+    "overlap.py",
+    "utils.py",
+)
+
+
+def _manifest_path(ncbi: str):
+    # one entry per genome, so pool workers never rewrite each other
+    return _DIRS["results"] / "manifest" / f"{ncbi}.json"
+
+
+def _load_entry(ncbi: str):
+    if _manifest_path(ncbi).is_file():
+        with open(_manifest_path(ncbi)) as entry:
+            return json.load(entry)
+
+
+def _save_entry(ncbi: str, entry):
+    _manifest_path(ncbi).parent.mkdir(exist_ok=True)
+    with atomic_path(_manifest_path(ncbi)) as tmp, open(tmp, "w") as out:
+        json.dump(entry, out, indent=1)
+
+
+@lru_cache(maxsize=None)
+def code_version():
+    """hash of the source of every module the results depend on"""
+    sha = hashlib.sha1()
+    root = Path(__file__).resolve().parent
+    for name in _RESULT_MODULES:
+        sha.update((root / name).read_bytes())
+    return sha.hexdigest()
+
+
+def file_digest(path, files):
+    """
+    SHA-1 of the file content, reused from `files` while the size and mtime
+    of the file stay the same
+    """
+    stat = path.stat()
+    key = f"{stat.st_size}:{stat.st_mtime_ns}"
+    cached = files.get(str(path))
+    if cached is not None and cached["stat"] == key:
+        return cached["sha1"]
+
+    sha = hashlib.sha1()
+    with open(path, "rb") as data:
+        for block in iter(lambda: data.read(1 << 20), b""):
+            sha.update(block)
+    files[str(path)] = {"stat": key, "sha1": sha.hexdigest()}
+    return files[str(path)]["sha1"]
+
+
+def _inputs(ncbi: str, analyses):
+    return [ncbi_to_feature(ncbi)] + [
+        _DIRS[analysis] / f"{ncbi}_{analysis}.csv" for analysis in analyses
+    ]
+
+
+def result_key(ncbi: str, analyses, files):
+    """Key of the results of one genome, changes with any of their inputs.
+
+    Args:
+        ncbi (str): NCBI ID of the processed sequence
+        analyses (tuple): analysis types written to the results
+        files (dict): cached file digests of the manifest entry, updated in place
+
+    Returns:
+        str: hash of the feature table, the analysis files, the analysis types and the code
+    """
+    parts = [file_digest(path, files) for path in _inputs(ncbi, analyses)]
+    parts += [*analyses, code_version()]
+    return hashlib.sha1(":".join(parts).encode()).hexdigest()
+
+
+def is_current(ncbi: str, analyses, fmt: str = "xlsx"):
+    """
+    whether results of the given genome exist, cover all given analyses and were made
+    from the current inputs, combined results of more analyses count too
+    """
+    entry = _load_entry(ncbi)
+    if entry is None:
+        return False
+
+    recorded = entry.get("analyses", [entry.get("analysis")])
+    if not set(analyses) <= set(recorded):
+        return False
+    if not result_exists(ncbi, recorded, fmt) or not all(
+        path.is_file() for path in _inputs(ncbi, recorded)
+    ):
+        return False
+
+    files = dict(entry.get("files", {}))
+    current = entry["key"] == result_key(ncbi, recorded, files)
+    if files != entry.get("files"):
+        _save_entry(ncbi, {**entry, "files": files})
+    return current
+
+
+def record_result(ncbi: str, analyses):
+    """Stores the key of freshly written results of the given genome in its manifest entry"""
+    files = dict((_load_entry(ncbi) or {}).get("files", {}))
+    key = result_key(ncbi, analyses, files)
+    _save_entry(ncbi, {"key": key, "analyses": list(analyses), "files": files})
@@ -0,0 +1,105 @@
+import json
+
+from lambdas import ncbi_to_sequence
+from utils import _DIRS, atomic_path
+
+# header words of NCBI records that are circular molecules
+_CIRCULAR_HINTS = (
+    "complete genome",
+    "plasmid",
+    "circular",
+    "mitochondri",
+    "chloroplast",
+)
+
+
+def _index_path(ncbi: str):
+    # one entry per file, so concurrent threads and processes never rewrite each other
+    return _DIRS["sequences"] / "index" / f"{ncbi}.json"
+
+
+def _file_key(path):
+    stat = path.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def scan_fasta(path):
+    """Reads the metadata of a FASTA file in one streaming pass.
+
+    Circularity is a heuristic on the record headers, NCBI marks complete bacterial
+    genomes, plasmids and organelles in the title but not in a dedicated field.
+
+    Args:
+        path (Path): FASTA file with one or more records
+
+    Returns:
+        dict: total `length` of all records, `gc` content as a fraction of the length
+            and whether all records look `circular`
+    """
+    length = gc = 0
+    headers = []
+
+    with open(path, "rb") as fasta:
+        for line in fasta:
+            if line.startswith(b">"):
+                headers.append(line[1:].decode(errors="replace").strip().lower())
+                continue
+            line = line.rstrip()
+            length += len(line)
+            gc += (
+                line.count(b"G")
+                + line.count(b"C")
+                + line.count(b"g")
+                + line.count(b"c")
+            )
+
+    return {
+        "length": length,
+        "gc": gc / length if length else 0.0,
+        "circular": bool(headers)
+        and all(any(hint in header for hint in _CIRCULAR_HINTS) for header in headers),
+    }
+
+
+def _load_entry(ncbi: str):
+    if _index_path(ncbi).is_file():
+        with open(_index_path(ncbi)) as entry:
+            return json.load(entry)
+
+
+def index_sequence(ncbi: str):
+    """Scans the FASTA of the given NCBI ID and stores its metadata in the sequence index"""
+    path = ncbi_to_sequence(ncbi)
+    info = {"key": _file_key(path), **scan_fasta(path)}
+
+    _index_path(ncbi).parent.mkdir(exist_ok=True)
+    with atomic_path(_index_path(ncbi)) as tmp, open(tmp, "w") as out:
+        json.dump(info, out, indent=1)
+    return info
+
+
+def sequence_info(ncbi: str):
+    """Metadata of a downloaded sequence: `length`, `gc` content and `circular` flag.
+
+    The FASTA file is scanned only the first time it is seen or after it changed,
+    later calls just look the values up in `sequences/index/{ncbi}.json`. A missing
+    FASTA file is downloaded first, FileNotFoundError is raised when that fails. The
+    `circular` flag is a guess from the record headers, kept as metadata only.
+    """
+    path = ncbi_to_sequence(ncbi)
+    if not path.is_file():
+        print(f"Missing sequence file {path}, trying to download...")
+        # the HTTP client is loaded only when something has to be downloaded
+        from remote_api import Remote
+
+        try:
+            Remote(ncbi).get_sequence()
+        except Exception as exc:
+            raise FileNotFoundError(
+                f"Sequence file {path} is missing and could not be downloaded: {exc}"
+            ) from exc
+
+    info = _load_entry(ncbi)
+    if info is None or info["key"] != _file_key(path):
+        info = index_sequence(ncbi)
+    return info
@@ -0,0 +1,107 @@
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import tenacity
+
+import remote_api
+from lambdas import ncbi_to_feature, ncbi_to_sequence
+from utils import _DIRS, check_dirs
+
+# records of the stub efetch, returned with a version like the real one
+RECORDS = {
+    "fasta": {
+        "NC_000001": b">NC_000001.1 Synthetic chromosome, complete genome\nACGTGC\nGG\n",
+        "NC_000002": b">NC_000002.1 Synthetic plasmid\nATAT\n",
+    },
+    "ft": {
+        "NC_000001": b">Feature ref|NC_000001.1|\n1\t8\tgene\n\t\t\tgene\tsyn\n",
+        "NC_000002": b">Feature ref|NC_000002.1|\n4\t1\tCDS\n",
+    },
+}
+
+
+class EfetchStub(BaseHTTPRequestHandler):
+    """
+    serves batched efetch responses, IDs without a record are left out of the
+    response, batches starting with an ID in `failing` get one 500 response before
+    they succeed, those starting with one in `broken` get nothing else
+    """
+
+    requests = Counter()
+    failing = set()
+    broken = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        ids, rettype = query["id"][0].split(","), query["rettype"][0]
+        self.requests[rettype, tuple(ids)] += 1
+
+        if (rettype, ids[0]) in self.failing | self.broken:
+            self.failing.discard((rettype, ids[0]))
+            self.send_error(500)
+            return
+
+        body = b"".join(RECORDS[rettype].get(ncbi, b"") for ncbi in ids)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def efetch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    check_dirs(_DIRS)
+    monkeypatch.setattr(remote_api.fetch_records.retry, "wait", tenacity.wait_none())
+    EfetchStub.requests.clear()
+    EfetchStub.failing.clear()
+    EfetchStub.broken.clear()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EfetchStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_prefetch_retries_and_reports_missing(efetch, capsys):
+    EfetchStub.failing.add(("ft", "NC_000001"))
+
+    failed = remote_api.prefetch(
+        ["NC_000001", "NC_000002", "NC_000003"], batch_size=2, base_url=efetch
+    )
+
+    assert failed == ["NC_000003"]
+    assert "NCBI returned no fasta records for NC_000003" in capsys.readouterr().out
+    # the error response was retried, the other batches were requested once
+    assert EfetchStub.requests == {
+        ("fasta", ("NC_000001", "NC_000002")): 1,
+        ("fasta", ("NC_000003",)): 1,
+        ("ft", ("NC_000001", "NC_000002")): 2,
+        ("ft", ("NC_000003",)): 1,
+    }
+
+    for ncbi in ("NC_000001", "NC_000002"):
+        assert ncbi_to_sequence(ncbi).read_bytes() == RECORDS["fasta"][ncbi]
+        assert ncbi_to_feature(ncbi).read_bytes() == RECORDS["ft"][ncbi]
+    assert not ncbi_to_sequence("NC_000003").exists()
+    assert not ncbi_to_feature("NC_000003").exists()
+    # sequences are indexed as they are downloaded
+    assert (_DIRS["sequences"] / "index" / "NC_000001.json").is_file()
+
+
+def test_fetch_records_gives_up_after_three_attempts(efetch):
+    EfetchStub.broken.add(("fasta", "NC_000001"))
+
+    with pytest.raises(remote_api.requests.HTTPError):
+        remote_api.fetch_records(["NC_000001"], "fasta", base_url=efetch)
+
+    assert EfetchStub.requests == {("fasta", ("NC_000001",)): 3}
+    assert not ncbi_to_sequence("NC_000001").exists()
@@ -0,0 +1,32 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from feature import process_feature_file
+from out import palindrome_stats
+
+DATA = Path(__file__).parent / "data"
+NCBI = "NC_000000.1"
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    for folder in ("features", "palindromes"):
+        shutil.copytree(DATA / folder, tmp_path / folder)
+    (tmp_path / "results").mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.mark.parametrize("chunksize", [None, 50])
+def test_palindrome_report_matches_baseline(workdir, chunksize):
+    """The text report is byte for byte the one the original pandas code printed.
+
+    The last feature's hits sum to 90.62500000000001%, summed in bulk it would
+    round down to 90.62% instead of 90.63%.
+    """
+    palindrome_stats(process_feature_file(NCBI, chunksize=chunksize), NCBI)
+
+    expected = (DATA / "results" / f"{NCBI}.txt").read_text()
+    assert (workdir / "results" / f"{NCBI}.txt").read_text() == expected
@@ -1,3 +1,6 @@
+import os
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 
 _DIRS = {
@@ -7,6 +10,18 @@ _DIRS = {
     "sequences": Path("./sequences/"),
     "rloop": Path("./rloops/"),
     "g4": Path("./g-quadruplexes/"),
+    "cache": Path("./cache/"),
+}
+
+# numeric columns used from the DNA Analyser exports
+_ANALYSIS_COLUMNS = {
+    "palindrome": {
+        "Position": "int32",
+        "Length": "int16",
+        "Spacer length": "int16",
+    },
+    "g4": {"POSITION": "int32", "LENGTH": "int16"},
+    "rloop": {"POSITION": "int32", "LENGTH": "int16"},
 }
 
 _CSV_HEADERS = [
@@ -37,3 +52,21 @@ def check_dirs(dirs):
     for dir in dirs.values():
         if not dir.exists() or not dir.is_dir():
             dir.mkdir()
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    yields a temporary path next to `path` and moves it into place once the block succeeds,
+    so readers never see a partially written file
+    """
+    path = Path(path)
+    tmp = path.with_name(
+        f".{path.stem}.tmp{os.getpid()}-{threading.get_ident()}{path.suffix}"
+    )
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()